@@ -1,15 +1,324 @@
 from base import *
+import heapq
+import base
+import scdf
 
-def ripple_add(a, b):
+# Bit vectors are lists of circuits with the least significant bit first.
+# Besides the ripple-carry adder, this module provides primitives whose
+# multiplicative depth grows logarithmically with the number of bits:
+# parallel-prefix adders, carry-save adder trees, column-compression
+# multipliers and a tree comparator. cost reports the depth and gate counts of
+# a primitive so callers can pick the cheapest for a given width.
+
+# The carry-in c_in lets ripple_add be used as the adder of sub
+@scdf.tagged('ripple_add')
+def ripple_add(a, b, c_in=zero):
     if len(a) != len(b):
         raise 'Unequal lengths'
     n = len(a)
     if n is 0:
         raise 'Length is zero'
-    s, c = half_adder(a[0], b[0])
+    if c_in is zero:
+        s, c = half_adder(a[0], b[0])
+    else:
+        s, c = full_adder(a[0], b[0], c_in)
     res = [s]
     for i in range(1, n):
         s, c = full_adder(a[i], b[i], c)
         res.append(s)
     res.append(c)
     return res
+
+
+# Gates with a zero or one constant operand are folded away as they are
+# built, so padding with zero costs nothing
+def _add(x, y):
+    folded = scdf.fold_gate(scdf.Gate.ADD, x, y)
+    if folded is None:
+        return x + y
+    return folded
+
+def _mul(x, y):
+    folded = scdf.fold_gate(scdf.Gate.MUL, x, y)
+    if folded is None:
+        return x * y
+    return folded
+
+def _pad(a, n):
+    return list(a) + [zero] * (n - len(a))
+
+# Bits are circuits or other nodes with the same operators, such as the handles
+# of stream.Builder, which give their multiplicative depth and fingerprint as
+# the depth and fingerprint attributes. The passes of scdf only take circuits,
+# so the other nodes are handled here.
+def _depth(bit, depths):
+    if isinstance(bit, scdf.Circuit):
+        return scdf.compute_depth(bit, depths)
+    return bit.depth
+
+# A product of the bits built as by scdf.construct_mul_tree
+def _mul_tree(bits):
+    if all(isinstance(bit, scdf.Circuit) for bit in bits):
+        return scdf.construct_mul_tree(bits)
+    depths = {}
+    heap = [(_depth(bit, depths), bit.fingerprint, i, bit)
+            for i, bit in enumerate(bits)]
+    heapq.heapify(heap)
+    count = len(heap)
+    while len(heap) >= 2:
+        left = heapq.heappop(heap)[3]
+        right = heapq.heappop(heap)[3]
+        product = left * right
+        heapq.heappush(heap, (_depth(product, depths), product.fingerprint,
+                              count, product))
+        count += 1
+    return heap[0][3]
+
+# The majority of three bits, which is the carry of a full adder. The terms
+# a*b and c*(a + b) are never both one, so their XOR is their OR.
+def majority(a, b, c):
+    return _add(_mul(a, b), _mul(c, _add(a, b)))
+
+def _full_add(a, b, c):
+    return (_add(_add(a, b), c), majority(a, b, c))
+
+def _half_add(a, b):
+    return (_add(a, b), _mul(a, b))
+
+
+# Parallel-prefix carry computation. Each position holds a (generate,
+# propagate) pair and the combination of a higher span with the adjacent lower
+# one is (g_hi + p_hi*g_lo, p_hi*p_lo). With propagate taken as a XOR b,
+# g_hi and p_hi are never both one, so ADD serves as OR. After the prefix
+# computation the generate bit at position i is the carry out of position i.
+
+def _combine(hi, lo):
+    return (_add(hi[0], _mul(hi[1], lo[0])), _mul(hi[1], lo[1]))
+
+# log2(n) levels of n combinations each
+def kogge_stone_prefix(gp):
+    gp = list(gp)
+    d = 1
+    while d < len(gp):
+        gp = gp[:d] + [_combine(gp[i], gp[i - d])
+                       for i in range(d, len(gp))]
+        d *= 2
+    return gp
+
+# 2 log2(n) - 1 levels but only about 2n combinations
+def brent_kung_prefix(gp):
+    gp = list(gp)
+    n = len(gp)
+    d = 1
+    while d < n:
+        for i in range(2*d - 1, n, 2*d):
+            gp[i] = _combine(gp[i], gp[i - d])
+        d *= 2
+    d //= 2
+    while d >= 1:
+        for i in range(3*d - 1, n, 2*d):
+            gp[i] = _combine(gp[i], gp[i - d])
+        d //= 2
+    return gp
+
+# Returns max(len(a), len(b)) + 1 bits
+def prefix_add(a, b, c_in=zero, prefix=kogge_stone_prefix):
+    n = max(len(a), len(b))
+    if n == 0:
+        raise Exception('Length is zero')
+    a = _pad(a, n)
+    b = _pad(b, n)
+    g = [_mul(a[i], b[i]) for i in range(n)]
+    p = [_add(a[i], b[i]) for i in range(n)]
+    g[0] = _add(g[0], _mul(p[0], c_in))
+    carries = [gp[0] for gp in prefix(zip(g, p))]
+    s = [_add(p[0], c_in)]
+    for i in range(1, n):
+        s.append(_add(p[i], carries[i - 1]))
+    s.append(carries[-1])
+    return s
+
+@scdf.tagged('kogge_stone_add')
+def kogge_stone_add(a, b, c_in=zero):
+    return prefix_add(a, b, c_in, kogge_stone_prefix)
+
+@scdf.tagged('brent_kung_add')
+def brent_kung_add(a, b, c_in=zero):
+    return prefix_add(a, b, c_in, brent_kung_prefix)
+
+add = kogge_stone_add
+
+# a - b modulo 2^n, computed as a + ~b + 1
+@scdf.tagged('sub')
+def sub(a, b, adder=add):
+    n = max(len(a), len(b))
+    return adder(a, [lnot(y) for y in _pad(b, n)], one)[:n]
+
+
+# Column compression. A column holds the bits of one weight; the bits of each
+# column are consumed shallowest first so that deep carries enter the
+# compressors as late as possible.
+
+def _columns(operands, shifts=None):
+    columns = []
+    for k, operand in enumerate(operands):
+        shift = 0 if shifts is None else shifts[k]
+        for i, bit in enumerate(operand):
+            while len(columns) <= i + shift:
+                columns.append([])
+            columns[i + shift].append(bit)
+    return columns
+
+def _by_depth(column, depths):
+    return sorted(column, key=lambda bit: _depth(bit, depths))
+
+# Wallace reduction: every layer compresses each column with as many full
+# adders as possible and a half adder for a remaining pair
+def _wallace_reduce(columns, width, depths):
+    while max(len(column) for column in columns) > 2:
+        reduced = [[] for k in range(len(columns) + 1)]
+        for k, column in enumerate(columns):
+            column = _by_depth(column, depths)
+            i = 0
+            while len(column) - i >= 3:
+                s, c = _full_add(column[i], column[i + 1], column[i + 2])
+                reduced[k].append(s)
+                reduced[k + 1].append(c)
+                i += 3
+            if len(column) - i == 2:
+                s, c = _half_add(column[i], column[i + 1])
+                reduced[k].append(s)
+                reduced[k + 1].append(c)
+            else:
+                reduced[k].extend(column[i:])
+        columns = reduced[:width]
+    return columns
+
+# Dadda reduction: each stage only compresses the columns exceeding the next
+# height in the sequence 2, 3, 4, 6, 9, ..., which uses fewer adders than
+# Wallace reduction for the same number of stages
+def _dadda_reduce(columns, width, depths):
+    heights = [2]
+    while heights[-1] < max(len(column) for column in columns):
+        heights.append(heights[-1] * 3 // 2)
+    for target in reversed(heights[:-1]):
+        reduced = [[] for k in range(len(columns) + 1)]
+        for k, column in enumerate(columns):
+            column = _by_depth(column, depths)
+            height = len(column) + len(reduced[k])
+            i = 0
+            while height > target:
+                if height == target + 1:
+                    s, c = _half_add(column[i], column[i + 1])
+                    i += 2
+                    height -= 1
+                else:
+                    s, c = _full_add(column[i], column[i + 1], column[i + 2])
+                    i += 3
+                    height -= 2
+                reduced[k].append(s)
+                reduced[k + 1].append(c)
+            reduced[k].extend(column[i:])
+        columns = reduced[:width]
+    return columns
+
+def _add_columns(columns, width, adder):
+    a = [column[0] if len(column) > 0 else zero for column in columns]
+    b = [column[1] if len(column) > 1 else zero for column in columns]
+    return _pad(adder(a, b)[:width], width)
+
+def _compress(columns, width, reducer, adder):
+    columns = columns[:width] + [[] for k in range(width - len(columns))]
+    if max(len(column) for column in columns) > 2:
+        columns = reducer(columns, width, {})
+    return _add_columns(columns, width, adder)
+
+# Sum of any number of operands with a carry-save adder tree, where layers of
+# full adders reduce three operands to two without propagating carries, and a
+# single final adder. The result has enough bits for any sum.
+@scdf.tagged('carry_save_add')
+def carry_save_add(operands, adder=add, reducer=_wallace_reduce):
+    if len(operands) == 0:
+        raise Exception('No operands to add')
+    width = max(len(operand) for operand in operands)
+    count = len(operands) - 1
+    while count > 0:
+        width += 1
+        count >>= 1
+    return _compress(_columns(operands), width, reducer, adder)
+
+def _partial_products(a, b):
+    return [[_mul(x, y) for x in a] for y in b]
+
+# Products of an n-bit and an m-bit number have n + m bits
+@scdf.tagged('wallace_mul')
+def wallace_mul(a, b, adder=add):
+    width = len(a) + len(b)
+    columns = _columns(_partial_products(a, b), range(len(b)))
+    return _compress(columns, width, _wallace_reduce, adder)
+
+@scdf.tagged('dadda_mul')
+def dadda_mul(a, b, adder=add):
+    width = len(a) + len(b)
+    columns = _columns(_partial_products(a, b), range(len(b)))
+    return _compress(columns, width, _dadda_reduce, adder)
+
+
+# Comparison by a balanced tree over the bits. Each span of bits holds
+# (less, equal) for the corresponding parts of the operands, and a higher span
+# is combined with the adjacent lower one as (l_hi + e_hi*l_lo, e_hi*e_lo).
+@scdf.tagged('lt_tree')
+def lt_tree(xs, ys):
+    if len(xs) != len(ys):
+        raise Exception('Unequal lengths')
+    spans = [(lt1(x, y), eq1(x, y)) for x, y in zip(xs, ys)]
+    while len(spans) > 1:
+        combined = []
+        for i in range(0, len(spans) - 1, 2):
+            combined.append(_combine(spans[i + 1], spans[i]))
+        if len(spans) % 2 == 1:
+            combined.append(spans[-1])
+        spans = combined
+    return spans[0][0]
+
+@scdf.tagged('eq_tree')
+def eq_tree(xs, ys):
+    if len(xs) != len(ys):
+        raise Exception('Unequal lengths')
+    return _mul_tree([eq1(x, y) for x, y in zip(xs, ys)])
+
+
+ADDERS = [ripple_add, kogge_stone_add, brent_kung_add]
+MULTIPLIERS = [wallace_mul, dadda_mul]
+COMPARATORS = [base.lt, lt_tree]
+
+_costs = {}
+
+# Primitives taking their operands as a single list
+LIST_PRIMITIVES = set([carry_save_add])
+
+# Returns the multiplicative depth and the gate counts of a primitive applied
+# to noperands nbits-bit inputs, which must be two except for primitives
+# taking a list of operands. Costs are measured on a built instance and
+# remembered.
+def cost(primitive, nbits, noperands=2):
+    key = (primitive, nbits, noperands)
+    if key not in _costs:
+        operands = [scdf.vect_input(chr(ord('a') + i), nbits)
+                    for i in range(noperands)]
+        if primitive in LIST_PRIMITIVES:
+            outputs = primitive(operands)
+        else:
+            outputs = primitive(*operands)
+        if isinstance(outputs, scdf.Circuit):
+            outputs = [outputs]
+        counts = scdf.count_gates_by_type(outputs)
+        _costs[key] = {'depth': scdf.compute_depth(outputs),
+                       'gates': sum(counts.values()),
+                       'muls': counts.get(scdf.Gate.MUL, 0)}
+    return dict(_costs[key])
+
+# The primitive with the lowest cost, comparing the cost entries in key order
+def cheapest(primitives, nbits, key=('depth', 'muls')):
+    return min(primitives,
+               key=lambda primitive: [cost(primitive, nbits)[k] for k in key])
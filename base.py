@@ -9,6 +9,7 @@ def eq1(x, y):
 def lor(x, y):
     return x*y + x + y
 
+@scdf.tagged('eq')
 def eq(xs, ys):
     is_eq = one
     for i in range(len(xs)):
@@ -21,6 +22,7 @@ def lnot(x):
 def lt1(x, y):
     return lnot(x) * y
 
+@scdf.tagged('lt')
 def lt(xs, ys):
     is_eq = one
     is_lt = lt1(xs[-1], ys[-1])
@@ -34,17 +36,20 @@ def lt(xs, ys):
 def mux1(sel, alt0, alt1):
     return lnot(sel)*alt0 + sel*alt1
 
+@scdf.tagged('mux')
 def mux(sel, alt0, alt1):
     t = []
     for i in range(len(alt0)):
         t.append(mux1(sel, alt0[i], alt1[i]))
     return t
 
+@scdf.tagged('half_adder')
 def half_adder(a, b):
     s = a + b
     c = a * b
     return (s, c)
 
+@scdf.tagged('full_adder')
 def full_adder(a, b, c_in):
 	s0 = a + b
 	s = s0 + c_in
@@ -0,0 +1,278 @@
+import argparse
+import gc
+import json
+import multiprocessing
+import platform
+import random
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import slots
+except ImportError:
+    slots = None
+
+import bitslice
+import hamming
+import scdf
+import sort
+import tape
+
+# Benchmarks for circuit construction, optimization and evaluation. Each case
+# builds one algorithm for a number of elements N (the vector length for the
+# hamming weight) and a number of bits per element, runs the selected passes
+# on all outputs together and evaluates the result on random inputs. Each
+# case runs in a separate process so its peak memory is its own. Results are
+# written as JSON and can be compared against the results of another run.
+
+def _sort_input(N, nbits):
+    return scdf.array_input('X', N, nbits)
+
+def _flatten(Y):
+    return [b for y in Y for b in y]
+
+# Each algorithm maps (N, nbits) to its output bits and states whether it
+# works on packed slot vectors
+ALGORITHMS = {
+    'direct_sort':
+        (lambda N, nbits: _flatten(sort.direct_sort(_sort_input(N, nbits))),
+         False),
+    'direct_sort_p':
+        (lambda N, nbits: _flatten(sort.direct_sort_p(_sort_input(N, nbits))),
+         True),
+    'sn_sort':
+        (lambda N, nbits: _flatten(sort.sn_sort(
+            sort.odd_even_merge_network(N), _sort_input(N, nbits))),
+         False),
+    'sn_sort_p':
+        (lambda N, nbits: _flatten(sort.sn_sort_p(
+            sort.odd_even_merge_network(N), _sort_input(N, nbits))),
+         True),
+    'hamming_weight_add':
+        (lambda N, nbits: hamming.hamming_weight_add(
+            scdf.vect_input('v', N)),
+         False),
+    'hamming_weight_direct':
+        (lambda N, nbits: hamming.hamming_weight_direct(
+            scdf.vect_input('v', N)),
+         False),
+}
+
+# Algorithms whose size only depends on N
+SIZE_ONLY = set(['hamming_weight_add', 'hamming_weight_direct'])
+
+# Passes run on all outputs at once
+PASSES = {
+    'fold_constants': lambda outputs, N:
+        scdf.fold_constants(outputs, None, 2, N),
+    'reduce_depth': lambda outputs, N: scdf.reduce_depth(outputs),
+    'simplify': lambda outputs, N: scdf.simplify(outputs),
+    'deduplicate': lambda outputs, N: scdf.deduplicate(outputs),
+    'normalize_gf2': lambda outputs, N: scdf.normalize_gf2(outputs),
+    'merge_rotations': lambda outputs, N: scdf.merge_rotations(outputs, N),
+    'place_mod_switches': lambda outputs, N:
+        scdf.place_mod_switches(outputs),
+}
+
+DEFAULT_PASSES = ['reduce_depth', 'simplify', 'deduplicate']
+
+# Peak resident set size of the process in kilobytes
+def peak_memory():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+def measure(outputs):
+    counts = scdf.count_gates_by_type(outputs)
+    return {
+        'depth': scdf.compute_depth(outputs),
+        'gates': dict((scdf.GATE_NAMES[gate_type], count)
+                      for gate_type, count in counts.iteritems()),
+    }
+
+def _input_map(compiled, N, packed, width, rng):
+    if packed:
+        if slots is None:
+            raise Exception('NumPy is required for packed algorithms')
+        return dict((name, slots.unit(rng.getrandbits(1), N))
+                    for name in compiled.input_names)
+    return bitslice.random_inputs(compiled.input_names, width, rng)
+
+def _timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return result, time.time() - start
+
+def run_case(algorithm, N, nbits, passes=DEFAULT_PASSES, width=64, repeat=1,
+             seed=0):
+    build, packed = ALGORITHMS[algorithm]
+    times = {}
+    outputs, times['build'] = _timed(build, N, nbits)
+    result = {'algorithm': algorithm, 'N': N, 'nbits': nbits,
+              'passes': list(passes), 'built': measure(outputs)}
+
+    for name in passes:
+        outputs, times[name] = _timed(PASSES[name], outputs, N)
+    result['optimized'] = measure(outputs)
+
+    compiled, times['compile'] = _timed(tape.compile, outputs)
+    input_map = _input_map(compiled, N, packed, width, random.Random(seed))
+    best = None
+    for i in range(repeat):
+        if packed:
+            values, elapsed = _timed(compiled.evaluate, input_map,
+                                     slots.constant_mapper(N))
+        else:
+            values, elapsed = _timed(bitslice.eval_batch, compiled,
+                                     input_map, width)
+        if best is None or elapsed < best:
+            best = elapsed
+    times['eval'] = best
+
+    result['times'] = times
+    result['peak_memory_kb'] = peak_memory()
+    return result
+
+def _run_case(args):
+    gc.collect()
+    return run_case(*args)
+
+def cases(algorithms, sizes, nbits_list):
+    for algorithm in algorithms:
+        for N in sizes:
+            if algorithm in SIZE_ONLY:
+                yield algorithm, N, None
+            else:
+                for nbits in nbits_list:
+                    yield algorithm, N, nbits
+
+def run(algorithms, sizes, nbits_list, passes=DEFAULT_PASSES, width=64,
+        repeat=1, seed=0, isolate=True):
+    results = []
+    for algorithm, N, nbits in cases(algorithms, sizes, nbits_list):
+        args = (algorithm, N, nbits, passes, width, repeat, seed)
+        try:
+            if isolate:
+                pool = multiprocessing.Pool(1)
+                try:
+                    result = pool.apply(_run_case, (args,))
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                result = _run_case(args)
+        except Exception as e:
+            result = {'algorithm': algorithm, 'N': N, 'nbits': nbits,
+                      'error': str(e)}
+        results.append(result)
+    return {'python': platform.python_version(),
+            'timestamp': time.time(),
+            'results': results}
+
+
+def _key(result):
+    return (result['algorithm'], result['N'], result['nbits'])
+
+# Compares two sets of results, returning the lines describing the
+# differences and whether any of them is a regression: an increase in depth
+# or in the number of gates of a type, or a time that grew by more than the
+# threshold (relative to the baseline). Times below min_time in both runs are
+# too noisy to compare.
+def compare(baseline, current, threshold=0.1, min_time=0.01):
+    lines = []
+    regressed = False
+    old_results = dict((_key(r), r) for r in baseline['results'])
+    for new in current['results']:
+        old = old_results.get(_key(new))
+        name = '%s N=%s nbits=%s' % _key(new)
+        if old is None or 'error' in old or 'error' in new:
+            continue
+        old_depth = old['optimized']['depth']
+        new_depth = new['optimized']['depth']
+        if old_depth != new_depth:
+            regressed |= new_depth > old_depth
+            lines.append('%s: depth %d -> %d' % (name, old_depth, new_depth))
+        old_gates = old['optimized']['gates']
+        new_gates = new['optimized']['gates']
+        for gate in sorted(set(old_gates) | set(new_gates)):
+            old_count = old_gates.get(gate, 0)
+            new_count = new_gates.get(gate, 0)
+            if old_count != new_count:
+                regressed |= new_count > old_count
+                lines.append('%s: %s gates %d -> %d' %
+                             (name, gate, old_count, new_count))
+        for phase in sorted(new['times']):
+            if phase not in old['times'] or old['times'][phase] == 0 or \
+               max(old['times'][phase], new['times'][phase]) < min_time:
+                continue
+            change = new['times'][phase] / old['times'][phase] - 1
+            if abs(change) > threshold:
+                regressed |= change > 0
+                lines.append('%s: %s time %.4fs -> %.4fs (%+.0f%%)' %
+                             (name, phase, old['times'][phase],
+                              new['times'][phase], 100 * change))
+    return lines, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark circuit construction, optimization and '
+                    'evaluation')
+    parser.add_argument('-a', '--algorithms', nargs='+',
+                        choices=sorted(ALGORITHMS), default=sorted(ALGORITHMS))
+    parser.add_argument('-N', '--sizes', nargs='+', type=int, default=[4, 8],
+                        help='numbers of elements (vector lengths for the '
+                             'hamming weight)')
+    parser.add_argument('-b', '--nbits', nargs='+', type=int, default=[4],
+                        help='numbers of bits per element')
+    parser.add_argument('-p', '--passes', nargs='*', choices=sorted(PASSES),
+                        default=DEFAULT_PASSES,
+                        help='passes to run, in order')
+    parser.add_argument('-w', '--width', type=int, default=64,
+                        help='assignments per bitsliced evaluation')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='evaluations to take the fastest of')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('--no-isolate', dest='isolate', action='store_false',
+                        help='run all cases in this process')
+    parser.add_argument('-o', '--output', help='file to write the results to')
+    parser.add_argument('-c', '--compare',
+                        help='results of a previous run to compare against')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='relative time change reported by --compare')
+    args = parser.parse_args(argv)
+
+    results = run(args.algorithms, args.sizes, args.nbits, args.passes,
+                  args.width, args.repeat, args.seed, args.isolate)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print text
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    for result in results['results']:
+        if 'error' in result:
+            print >> sys.stderr, '%s N=%s nbits=%s: %s' % (
+                _key(result) + (result['error'],))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        lines, regressed = compare(baseline, results, args.threshold)
+        for line in lines:
+            print >> sys.stderr, line
+        if regressed:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
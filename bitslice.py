@@ -0,0 +1,102 @@
+import random
+from itertools import izip
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import scdf
+import tape
+import utils
+
+# Bitsliced evaluation of plaintext Boolean circuits. Every input is bound to
+# a packed word holding many independent assignments, one per bit: either a
+# Python int of a given width or a NumPy uint64 array holding 64 assignments
+# per element. ADD is evaluated as XOR and MUL as AND, so a single pass over
+# the circuit evaluates all assignments at once.
+
+def is_array(word):
+    return np is not None and isinstance(word, np.ndarray)
+
+def ones_like(word, width=None):
+    if is_array(word):
+        return np.full(word.shape, np.iinfo(np.uint64).max, dtype=np.uint64)
+    if width is None:
+        raise Exception('Width required for int words')
+    return (1 << width) - 1
+
+def run(compiled, inputs, ones):
+    if len(inputs) != len(compiled.input_names):
+        raise Exception('Number of inputs does not match the tape')
+    zero = ones ^ ones
+    slots = list(inputs)
+    for constant in compiled.constants:
+        slots.append(ones if constant % 2 else zero)
+    slots.extend([None] * len(compiled))
+
+    ADD = scdf.Gate.ADD
+    MUL = scdf.Gate.MUL
+    MOD_SWITCH = scdf.Gate.MOD_SWITCH
+    dest = len(compiled.input_names) + len(compiled.constants)
+    for op, a, b in izip(compiled.opcodes, compiled.lhs, compiled.rhs):
+        if op == ADD:
+            slots[dest] = slots[a] ^ slots[b]
+        elif op == MUL:
+            slots[dest] = slots[a] & slots[b]
+        elif op == MOD_SWITCH:
+            slots[dest] = slots[a]
+        else:
+            raise Exception('Shift gates are not supported in bitsliced '
+                            'evaluation')
+        dest += 1
+
+    return [slots[i] for i in compiled.outputs]
+
+# Evaluates the outputs (a circuit, a list of circuits or a compiled tape)
+# with each input bound to a packed word. The width is only needed when the
+# words are ints.
+def eval_batch(outputs, input_map, width=None):
+    if not isinstance(outputs, tape.Tape):
+        outputs = tape.compile(outputs)
+    inputs = outputs.input_vector(input_map)
+    if len(inputs) == 0:
+        raise Exception('Circuit has no inputs')
+    return run(outputs, inputs, ones_like(inputs[0], width))
+
+
+def random_word(width, rng=random, as_array=False):
+    if as_array:
+        if np is None:
+            raise Exception('NumPy is required for array words')
+        if width % 64 != 0:
+            raise Exception('Width of array words must be a multiple of 64')
+        return np.array([rng.getrandbits(64) for i in range(width // 64)],
+                        dtype=np.uint64)
+    return rng.getrandbits(width)
+
+def random_inputs(names, width, rng=random, as_array=False):
+    return dict((name, random_word(width, rng, as_array)) for name in names)
+
+# Returns the value of a word in each of its assignments
+def unpack(word, width=None):
+    if is_array(word):
+        shifts = np.arange(64, dtype=np.uint64)
+        bits = (word[:, np.newaxis] >> shifts) & np.uint64(1)
+        return bits.reshape(-1).astype(np.uint8)
+    if width is None:
+        raise Exception('Width required for int words')
+    return [(word >> i) & 1 for i in range(width)]
+
+# Returns the number in each assignment of words holding its bits, least
+# significant first
+def unpack_numbers(words, width=None):
+    bits = [unpack(word, width) for word in words]
+    return [utils.from_bin([b[j] for b in bits]) for j in range(len(bits[0]))]
+
+def pack(bits):
+    word = 0
+    for i, b in enumerate(bits):
+        if b & 1:
+            word |= 1 << i
+    return word
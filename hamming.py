@@ -1,8 +1,10 @@
 from base import *
 import arith
+import scdf
 from math import log
 import utils
 
+@scdf.tagged('hamming_weight_add')
 def hamming_weight_add(v):
     n = len(v)
     if not utils.is_power_of_2(n):
@@ -18,6 +20,7 @@ def hamming_weight_add(v):
 
 # This algorithm builds upon and generalizes an approach by
 # Cetin, Doroz, Sunar and Savas and handles vectors of any length
+@scdf.tagged('hamming_weight_direct')
 def hamming_weight_direct(v):
     c = v
     result_len = int(log(len(v), 2)) + 1
@@ -0,0 +1,114 @@
+import heapq
+
+import scdf
+import tape
+
+# Incremental evaluation over a compiled tape. The value of every slot from the
+# last evaluation is kept, so when some inputs change only the gates in their
+# transitive fan-out are recomputed, in tape order. Propagation stops at gates
+# whose recomputed value equals the previous one.
+
+def values_equal(left, right):
+    if left is right:
+        return True
+    result = left == right
+    # Elementwise comparisons such as those of NumPy arrays
+    if hasattr(result, 'all'):
+        return bool(result.all())
+    return bool(result)
+
+class IncrementalEvaluator(object):
+    def __init__(self, outputs, map_constant, equal=values_equal):
+        if isinstance(outputs, tape.Tape):
+            self._tape = outputs
+        else:
+            self._tape = tape.compile(outputs)
+        self._map_constant = map_constant
+        self._equal = equal
+        self._slots = None
+        self._recomputed = 0
+
+        compiled = self._tape
+        self._base = len(compiled.input_names) + len(compiled.constants)
+        self._input_slots = dict((name, i)
+                                 for i, name in enumerate(compiled.input_names))
+        self._consumers = [[] for i in range(compiled.num_slots)]
+        for i in range(len(compiled)):
+            self._consumers[compiled.lhs[i]].append(i)
+            if not scdf.is_unary_type(compiled.opcodes[i]) and \
+               compiled.rhs[i] != compiled.lhs[i]:
+                self._consumers[compiled.rhs[i]].append(i)
+
+    @property
+    def tape(self):
+        return self._tape
+
+    # Number of gates recomputed by the last call to evaluate or update
+    @property
+    def recomputed(self):
+        return self._recomputed
+
+    @property
+    def outputs(self):
+        if self._slots is None:
+            raise Exception('Circuit has not been evaluated')
+        return [self._slots[i] for i in self._tape.outputs]
+
+    def _compute(self, i):
+        op = self._tape.opcodes[i]
+        left = self._slots[self._tape.lhs[i]]
+        right = self._tape.rhs[i]
+        if op == scdf.Gate.ADD:
+            return left + self._slots[right]
+        elif op == scdf.Gate.MUL:
+            return left * self._slots[right]
+        elif op == scdf.Gate.SHIFT_LEFT:
+            return left << right
+        elif op == scdf.Gate.SHIFT_RIGHT:
+            return left >> right
+        return scdf.mod_switch_value(left, right)
+
+    def evaluate(self, input_map):
+        compiled = self._tape
+        self._slots = compiled.input_vector(input_map)
+        self._slots.extend(map(self._map_constant, compiled.constants))
+        self._slots.extend([None] * len(compiled))
+        for i in range(len(compiled)):
+            self._slots[self._base + i] = self._compute(i)
+        self._recomputed = len(compiled)
+        return self.outputs
+
+    # Applies a map from input names to their new values and recomputes the
+    # gates affected by the inputs whose values changed
+    def update(self, changes):
+        if self._slots is None:
+            raise Exception('Circuit has not been evaluated')
+
+        pending = []
+        queued = set()
+
+        def schedule(slot):
+            for i in self._consumers[slot]:
+                if i not in queued:
+                    queued.add(i)
+                    heapq.heappush(pending, i)
+
+        for name, value in changes.iteritems():
+            if name not in self._input_slots:
+                raise Exception('Input not found in circuit')
+            slot = self._input_slots[name]
+            if not self._equal(self._slots[slot], value):
+                self._slots[slot] = value
+                schedule(slot)
+
+        self._recomputed = 0
+        while len(pending) != 0:
+            i = heapq.heappop(pending)
+            value = self._compute(i)
+            self._recomputed += 1
+            slot = self._base + i
+            if not self._equal(self._slots[slot], value):
+                self._slots[slot] = value
+                schedule(slot)
+
+        return self.outputs
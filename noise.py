@@ -0,0 +1,262 @@
+import scdf
+import tape
+
+# Cost and noise simulation of leveled FHE evaluation, for sizing parameters
+# without running an FHE library. Estimate values stand in for ciphertexts and
+# plaintexts in eval_circuit or a compiled tape. Each ciphertext estimate
+# carries its level (the number of ciphertext multiplications on its deepest
+# path, each of which consumes one prime of the modulus chain) and the noise
+# budget it has consumed in bits. The Simulator that created the values counts
+# the operations performed at each level, from which the wall-clock time is
+# estimated once the length of the modulus chain is known.
+
+class NoiseModel(object):
+    # Noise growth is given in bits of budget consumed. Costs are in seconds
+    # per operation per prime of the modulus at the level the operation runs
+    # at, since RNS operations scale with the number of primes. The defaults
+    # are rough figures for a BGV-like scheme with a plaintext modulus of 2 and
+    # should be calibrated against the target library.
+    def __init__(self, fresh=10, add=1, plain_add=0, mul=30, plain_mul=10,
+                 rotate=2, plaintext_bits=1, margin=10, max_prime_bits=60,
+                 costs=None):
+        self.fresh = fresh
+        self.add = add
+        self.plain_add = plain_add
+        self.mul = mul
+        self.plain_mul = plain_mul
+        self.rotate = rotate
+        self.plaintext_bits = plaintext_bits
+        self.margin = margin
+        self.max_prime_bits = max_prime_bits
+        self.costs = {
+            'add': 2e-6,
+            'plain_add': 1e-6,
+            'mul': 1e-4,
+            'relinearize': 4e-4,
+            'plain_mul': 5e-6,
+            'rotate': 4e-4,
+            'mod_switch': 2e-5,
+        }
+        if costs is not None:
+            self.costs.update(costs)
+
+
+class Estimate(object):
+    __slots__ = ('_simulator', '_level', '_consumed', '_is_plain')
+
+    def __init__(self, simulator, level, consumed, is_plain):
+        self._simulator = simulator
+        self._level = level
+        self._consumed = consumed
+        self._is_plain = is_plain
+
+    @property
+    def level(self):
+        return self._level
+
+    # Bits of noise budget consumed
+    @property
+    def consumed(self):
+        return self._consumed
+
+    @property
+    def is_plain(self):
+        return self._is_plain
+
+    # Remaining noise budget in bits, if the simulator has a modulus size
+    @property
+    def budget(self):
+        return self._simulator.budget(self)
+
+    def __add__(self, other):
+        sim = self._simulator
+        model = sim.model
+        if self._is_plain and other._is_plain:
+            return sim.plaintext()
+        if other._is_plain or self._is_plain:
+            ct = other if self._is_plain else self
+            sim._record('plain_add', ct._level)
+            return sim._ciphertext(ct._level, ct._consumed + model.plain_add)
+        level = max(self._level, other._level)
+        if self._level != other._level:
+            # the shallower operand is switched down to the level of the other
+            sim._record('mod_switch', min(self._level, other._level))
+        sim._record('add', level)
+        return sim._ciphertext(level, max(self._consumed, other._consumed) +
+                               model.add)
+
+    def __mul__(self, other):
+        sim = self._simulator
+        model = sim.model
+        if self._is_plain and other._is_plain:
+            return sim.plaintext()
+        if other._is_plain or self._is_plain:
+            ct = other if self._is_plain else self
+            sim._record('plain_mul', ct._level)
+            return sim._ciphertext(ct._level, ct._consumed + model.plain_mul)
+        level = max(self._level, other._level)
+        if self._level != other._level:
+            sim._record('mod_switch', min(self._level, other._level))
+        sim._record('mul', level)
+        sim._record('relinearize', level)
+        return sim._ciphertext(level + 1, max(self._consumed, other._consumed) +
+                               model.mul)
+
+    def _rotate(self):
+        sim = self._simulator
+        if self._is_plain:
+            return sim.plaintext()
+        sim._record('rotate', self._level)
+        return sim._ciphertext(self._level, self._consumed + sim.model.rotate)
+
+    # Switching down drops primes from the modulus, and the noise with them,
+    # so the budget consumed is unchanged
+    def mod_switch(self, num_levels):
+        sim = self._simulator
+        if self._is_plain:
+            return self
+        sim._record('mod_switch', self._level)
+        return sim._ciphertext(self._level + num_levels, self._consumed)
+
+    def __lshift__(self, num_places):
+        return self._rotate()
+
+    def __rshift__(self, num_places):
+        return self._rotate()
+
+    def __repr__(self):
+        if self._is_plain:
+            return 'Estimate(plaintext)'
+        return 'Estimate(level=%d, consumed=%d)' % (self._level,
+                                                    self._consumed)
+
+
+class Simulator(object):
+    # With modulus_bits given, ciphertexts whose consumed budget exceeds it are
+    # counted as exhausted
+    def __init__(self, model=None, modulus_bits=None):
+        if model is None:
+            model = NoiseModel()
+        self.model = model
+        self.modulus_bits = modulus_bits
+        self.reset()
+
+    def reset(self):
+        self._ops = {}
+        self._max_level = 0
+        self._max_consumed = 0
+        self._exhausted = 0
+
+    def encrypt(self):
+        return self._ciphertext(0, self.model.fresh)
+
+    def plaintext(self):
+        return Estimate(self, 0, 0, True)
+
+    # map_constant for eval_circuit: constants are plaintexts
+    def map_constant(self, value):
+        return self.plaintext()
+
+    # Binds every input of the circuits (or tape) to a fresh ciphertext
+    def input_map(self, outputs):
+        if not isinstance(outputs, tape.Tape):
+            outputs = tape.compile(outputs)
+        return dict((name, self.encrypt()) for name in outputs.input_names)
+
+    def budget(self, value):
+        if value.is_plain or self.modulus_bits is None:
+            return None
+        return self.modulus_bits - self.model.plaintext_bits - value.consumed
+
+    def is_exhausted(self, value):
+        budget = self.budget(value)
+        return budget is not None and budget <= 0
+
+    def _ciphertext(self, level, consumed):
+        value = Estimate(self, level, consumed, False)
+        self._max_level = max(self._max_level, level)
+        self._max_consumed = max(self._max_consumed, consumed)
+        if self.is_exhausted(value):
+            self._exhausted += 1
+        return value
+
+    def _record(self, op, level):
+        levels = self._ops.setdefault(op, {})
+        levels[level] = levels.get(level, 0) + 1
+
+    # Operation counts by operation and level
+    @property
+    def operations(self):
+        return dict((op, dict(levels)) for op, levels in self._ops.iteritems())
+
+    @property
+    def max_level(self):
+        return self._max_level
+
+    @property
+    def exhausted(self):
+        return self._exhausted
+
+    # The smallest modulus chain, as prime sizes in bits from the last prime
+    # dropped to the first, for which no ciphertext seen runs out of noise
+    # budget: a prime of model.mul bits per level, absorbing the growth of
+    # one multiplication each, and base primes for the rest of the budget
+    def modulus_chain(self):
+        model = self.model
+        total = self._max_consumed + model.plaintext_bits + model.margin
+        primes = [model.mul] * self._max_level
+        rest = max(total - sum(primes), model.plaintext_bits + model.margin)
+        count = -(-rest // model.max_prime_bits)
+        base = [rest // count + (1 if i < rest % count else 0)
+                for i in range(count)]
+        return base + primes
+
+    # Estimated time of the operations recorded, where an operation at level l
+    # runs with all but the first l primes of the chain remaining
+    def wall_clock(self, chain=None):
+        if chain is None:
+            chain = self.modulus_chain()
+        total = 0.0
+        for op, levels in self._ops.iteritems():
+            for level, count in levels.iteritems():
+                total += self.model.costs[op] * count * \
+                    max(len(chain) - level, 1)
+        return total
+
+    def report(self):
+        chain = self.modulus_chain()
+        return {
+            'levels': self._max_level,
+            'consumed': self._max_consumed,
+            'modulus_chain': chain,
+            'log_q': sum(chain),
+            'wall_clock': self.wall_clock(chain),
+            'operations': dict((op, sum(levels.values()))
+                               for op, levels in self._ops.iteritems()),
+            'exhausted': self._exhausted,
+        }
+
+
+# Simulates the evaluation of the outputs (a circuit or a list of circuits)
+# with every input a fresh ciphertext and returns the report of the
+# simulator. With modulus_bits given, the report also lists the gates where
+# the noise runs out: those whose value is exhausted but none of whose
+# operands are.
+def simulate(outputs, model=None, modulus_bits=None):
+    if isinstance(outputs, scdf.Circuit):
+        outputs = [outputs]
+    sim = Simulator(model, modulus_bits)
+    values = scdf.eval_nodes(outputs, sim.input_map(outputs),
+                             sim.map_constant)
+
+    report = sim.report()
+    if modulus_bits is not None:
+        exhausted = []
+        for node in scdf.postorder(outputs):
+            if node.is_terminal or not sim.is_exhausted(values[node]):
+                continue
+            if not any(sim.is_exhausted(values[child])
+                       for child in scdf.children(node)):
+                exhausted.append(node)
+        report['exhausted_nodes'] = exhausted
+    return report
@@ -0,0 +1,98 @@
+import scdf
+import tape
+
+# Level-scheduled evaluation. The compiled tape is partitioned into
+# topological levels, where every gate in a level only depends on inputs,
+# constants and gates in earlier levels, and the gates of each level are
+# dispatched together to an executor. Any object with a map method can be used,
+# such as a concurrent.futures ThreadPoolExecutor or ProcessPoolExecutor; with a
+# process pool the backend and the values must be picklable.
+
+# The default value backend applies the operators of the values themselves, as
+# eval_circuit does
+class OperatorBackend(object):
+    def add(self, left, right):
+        return left + right
+
+    def mul(self, left, right):
+        return left * right
+
+    def shift_left(self, value, num_places):
+        return value << num_places
+
+    def shift_right(self, value, num_places):
+        return value >> num_places
+
+    def mod_switch(self, value, num_levels):
+        return scdf.mod_switch_value(value, num_levels)
+
+
+def _apply_gates(tasks):
+    results = []
+    for backend, op, left, right in tasks:
+        if op == scdf.Gate.ADD:
+            results.append(backend.add(left, right))
+        elif op == scdf.Gate.MUL:
+            results.append(backend.mul(left, right))
+        elif op == scdf.Gate.SHIFT_LEFT:
+            results.append(backend.shift_left(left, right))
+        elif op == scdf.Gate.SHIFT_RIGHT:
+            results.append(backend.shift_right(left, right))
+        else:
+            results.append(backend.mod_switch(left, right))
+    return results
+
+# Returns the instruction indices of the tape grouped by topological level
+def schedule(compiled):
+    base = len(compiled.input_names) + len(compiled.constants)
+    slot_levels = [0] * compiled.num_slots
+    levels = []
+    for i in range(len(compiled)):
+        level = slot_levels[compiled.lhs[i]]
+        if not scdf.is_unary_type(compiled.opcodes[i]):
+            level = max(level, slot_levels[compiled.rhs[i]])
+        slot_levels[base + i] = level + 1
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(i)
+    return levels
+
+def eval_parallel(outputs, input_map, map_constant, executor=None,
+                  backend=None, chunk_size=1):
+    single = isinstance(outputs, scdf.Circuit)
+    if isinstance(outputs, tape.Tape):
+        compiled = outputs
+    else:
+        compiled = tape.compile(outputs)
+    if backend is None:
+        backend = OperatorBackend()
+    run_map = map if executor is None else executor.map
+
+    slots = compiled.input_vector(input_map)
+    slots.extend(map(map_constant, compiled.constants))
+    slots.extend([None] * len(compiled))
+    base = len(compiled.input_names) + len(compiled.constants)
+
+    opcodes = compiled.opcodes
+    lhs = compiled.lhs
+    rhs = compiled.rhs
+    for level in schedule(compiled):
+        tasks = []
+        for i in level:
+            if scdf.is_unary_type(opcodes[i]):
+                right = rhs[i]
+            else:
+                right = slots[rhs[i]]
+            tasks.append((backend, opcodes[i], slots[lhs[i]], right))
+        chunks = [tasks[j:j + chunk_size]
+                  for j in range(0, len(tasks), chunk_size)]
+        j = 0
+        for results in run_map(_apply_gates, chunks):
+            for value in results:
+                slots[base + level[j]] = value
+                j += 1
+
+    values = [slots[i] for i in compiled.outputs]
+    if single:
+        return values[0]
+    return values
@@ -0,0 +1,141 @@
+import json
+import sys
+import weakref
+
+import scdf
+
+# Evaluation profiler. A Profiler is passed to eval_circuit as its observer
+# and records the gate type, region tag, topological level (the number of gates
+# on the longest path from an input), start time and duration of every gate
+# evaluated. The records can be summarized as a flat profile with latency
+# percentiles by gate type, by tagged region and by level, or exported as
+# Chrome trace events (viewable in chrome://tracing or Perfetto).
+
+PERCENTILES = (50, 90, 99)
+
+# Nearest-rank percentile of a sorted list
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    rank = max(int(-(-p * len(values) // 100)), 1)
+    return values[rank - 1]
+
+def _summary(times):
+    times = sorted(times)
+    total = sum(times)
+    summary = {'calls': len(times), 'total': total,
+               'mean': total / len(times), 'max': times[-1]}
+    for p in PERCENTILES:
+        summary['p%d' % p] = percentile(times, p)
+    return summary
+
+class Profiler(object):
+    def __init__(self):
+        self.reset()
+
+    # Levels are held by weak reference to the nodes, so profiling does not
+    # keep the circuits evaluated alive
+    def reset(self):
+        self._records = []
+        self._levels = weakref.WeakKeyDictionary()
+
+    @property
+    def records(self):
+        return self._records
+
+    def _level(self, node):
+        if node.is_terminal:
+            return 0
+        return self._levels.get(node, 0)
+
+    def gate(self, node, start, elapsed):
+        level = self._level(node.left)
+        if not scdf.is_unary(node):
+            level = max(level, self._level(node.right))
+        level += 1
+        self._levels[node] = level
+        self._records.append((node.gate_type, node.tag, level, start,
+                              elapsed))
+
+    def _group(self, key):
+        groups = {}
+        for record in self._records:
+            groups.setdefault(key(record), []).append(record[4])
+        return groups
+
+    # Call counts and latency statistics by gate type name
+    def by_gate_type(self):
+        groups = self._group(lambda record: scdf.GATE_NAMES[record[0]])
+        return dict((name, _summary(times))
+                    for name, times in groups.iteritems())
+
+    # Statistics by region, including the gates of nested regions. Untagged
+    # gates are reported under None.
+    def by_region(self):
+        groups = {}
+        for gate_type, tag, level, start, elapsed in self._records:
+            if tag is None:
+                groups.setdefault(None, []).append(elapsed)
+                continue
+            names = tag.split('/')
+            for i in range(1, len(names) + 1):
+                groups.setdefault('/'.join(names[:i]), []).append(elapsed)
+        return dict((tag, _summary(times))
+                    for tag, times in groups.iteritems())
+
+    # Statistics by topological level, as a list indexed by level - 1
+    def by_level(self):
+        groups = self._group(lambda record: record[2])
+        if len(groups) == 0:
+            return []
+        return [_summary(groups.get(level, [0.0]))
+                for level in range(1, max(groups) + 1)]
+
+    def flat_profile(self):
+        return {'gate_types': self.by_gate_type(),
+                'regions': self.by_region(),
+                'levels': self.by_level()}
+
+    def report(self, out=sys.stdout):
+        columns = ['calls', 'total', 'mean'] + \
+            ['p%d' % p for p in PERCENTILES] + ['max']
+        header = '%-40s %8s' + ' %10s' * (len(columns) - 1) + '\n'
+        row = '%-40s %8d' + ' %10.6f' * (len(columns) - 1) + '\n'
+
+        def write_table(title, summaries):
+            out.write(header % tuple([title] + columns))
+            for name, summary in summaries:
+                out.write(row % tuple([str(name)] +
+                                      [summary[c] for c in columns]))
+            out.write('\n')
+
+        by_total = lambda item: -item[1]['total']
+        write_table('gate type', sorted(self.by_gate_type().iteritems(),
+                                        key=by_total))
+        write_table('region', sorted(self.by_region().iteritems(),
+                                     key=by_total))
+        write_table('level', [(i + 1, summary)
+                              for i, summary in enumerate(self.by_level())])
+
+    # Chrome trace-event format, with one complete event per gate and times
+    # in microseconds from the first gate
+    def chrome_trace(self):
+        events = []
+        if len(self._records) != 0:
+            origin = min(record[3] for record in self._records)
+        for gate_type, tag, level, start, elapsed in self._records:
+            events.append({
+                'name': scdf.GATE_NAMES[gate_type],
+                'cat': tag if tag is not None else 'untagged',
+                'ph': 'X',
+                'ts': (start - origin) * 1e6,
+                'dur': elapsed * 1e6,
+                'pid': 0,
+                'tid': 0,
+                'args': {'level': level, 'region': tag},
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
@@ -1,8 +1,131 @@
+import functools
+import heapq
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# When interning is enabled, node construction returns the existing node for a
+# structurally identical node. The unique table is keyed on child identities
+# (commutative operands ordered) and only holds weak references, so nodes that
+# are no longer used elsewhere drop out of it.
+_unique_table = weakref.WeakValueDictionary()
+_interning = False
+
+def set_interning(enabled):
+    global _interning
+    _interning = enabled
+
+def is_interning():
+    return _interning
+
+def clear_unique_table():
+    _unique_table.clear()
+
+def _intern(cls, key):
+    node = _unique_table.get(key)
+    if node is None:
+        node = object.__new__(cls)
+        _unique_table[key] = node
+    return node
+
+def _gate_key(gate_type, left, right):
+    if gate_type is Gate.ADD or gate_type is Gate.MUL:
+        left_id = id(left)
+        right_id = id(right)
+        if left_id > right_id:
+            left_id, right_id = right_id, left_id
+        return (gate_type, left_id, right_id)
+    return (gate_type, id(left), right)
+
+# When build-time constant folding is enabled, it holds the modulus and number
+# of slots used to fold constants as gates are constructed
+_folding = None
+
+def set_constant_folding(enabled, modulus=None, nslots=None):
+    global _folding
+    if enabled:
+        _folding = (modulus, nslots)
+    else:
+        _folding = None
+
+def is_constant_folding():
+    return _folding is not None
+
+# Gates are tagged with the region they are built in, a '/'-separated path of
+# the names of the enclosing regions, so that evaluation profiles can be broken
+# down by the sub-circuits that builder functions produce
+_region = None
+
+@contextmanager
+def region(name):
+    global _region
+    outer = _region
+    if outer is None:
+        _region = name
+    else:
+        _region = outer + '/' + name
+    try:
+        yield
+    finally:
+        _region = outer
+
+def current_region():
+    return _region
+
+# Decorator running a builder function in a region
+def tagged(name):
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with region(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# Passes give the node replacing a tagged node its tag if it has none, and
+# build larger replacements in the region of the node they replace
+def _inherit_tag(new_node, node):
+    if not new_node.is_terminal and new_node._tag is None:
+        new_node._tag = node.tag
+    return new_node
+
+class _replacing(object):
+    __slots__ = ('_tag', '_outer')
+
+    def __init__(self, node):
+        self._tag = node.tag
+
+    def __enter__(self):
+        global _region
+        self._outer = _region
+        _region = self._tag
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _region
+        _region = self._outer
+
+def _terminal_key(circ):
+    if circ.is_constant:
+        return ('constant',) + _constant_key(circ.value)
+    return ('input', circ.name)
+
+
+# Nodes use __slots__ to keep large circuits compact in memory
 class Circuit(object):
+    __slots__ = ('_fingerprint', '__weakref__')
+
+    # Other operand types may implement the reflected operators, as the
+    # streaming builder handles do
     def __add__(self, other):
+        if not isinstance(other, Circuit):
+            return NotImplemented
         return Gate(Gate.ADD, self, other)
 
     def __mul__(self, other):
+        if not isinstance(other, Circuit):
+            return NotImplemented
         return Gate(Gate.MUL, self, other)
 
     def __lshift__(self, num_places):
@@ -11,21 +134,59 @@ class Circuit(object):
     def __rshift__(self, num_places):
         return Gate(Gate.SHIFT_RIGHT, self, num_places)
 
+    def mod_switch(self, num_levels):
+        return Gate(Gate.MOD_SWITCH, self, num_levels)
+
     @property
     def is_terminal(self):
         pass
 
+    @property
+    def tag(self):
+        return None
+
+    # Canonical structural hash computed once at construction time. ADD and MUL
+    # operands are ordered so that commuted circuits get the same fingerprint.
+    @property
+    def fingerprint(self):
+        return self._fingerprint
+
 
 class Gate(Circuit):
+    __slots__ = ('_gate_type', '_left', '_right', '_tag')
+
     ADD = 1
     MUL = 2
     SHIFT_LEFT = 3
     SHIFT_RIGHT = 4
+    # Switches a ciphertext down by a number of levels of the modulus chain
+    MOD_SWITCH = 5
+
+    def __new__(cls, gate_type, left, right):
+        if _folding is not None:
+            folded = fold_gate(gate_type, left, right, *_folding)
+            if folded is not None:
+                return folded
+        if not _interning:
+            return super(Gate, cls).__new__(cls)
+        return _intern(cls, _gate_key(gate_type, left, right))
 
     def __init__(self, gate_type, left, right):
+        if hasattr(self, '_gate_type'):
+            # An interned or folded node is being returned
+            return
         self._gate_type = gate_type
         self._left = left
         self._right = right
+        self._tag = _region
+        if gate_type is Gate.ADD or gate_type is Gate.MUL:
+            left_fp = left.fingerprint
+            right_fp = right.fingerprint
+            if left_fp > right_fp:
+                left_fp, right_fp = right_fp, left_fp
+            self._fingerprint = hash((gate_type, left_fp, right_fp))
+        else:
+            self._fingerprint = hash((gate_type, left.fingerprint, right))
 
     @property
     def is_terminal(self):
@@ -43,7 +204,25 @@ class Gate(Circuit):
     def right(self):
         return self._right
 
+    @property
+    def tag(self):
+        return self._tag
+
+    # Copies and unpickled nodes are built through the constructors, so they
+    # are interned and shared like any other node
+    def __reduce__(self):
+        return (_rebuild_gate,
+                (self._gate_type, self._left, self._right, self._tag))
+
+def _rebuild_gate(gate_type, left, right, tag):
+    gate = Gate(gate_type, left, right)
+    if not gate.is_terminal and gate._tag is None:
+        gate._tag = tag
+    return gate
+
 class Terminal(Circuit):
+    __slots__ = ('_is_constant',)
+
     def __init__(self, is_constant):
         self._is_constant = is_constant
 
@@ -56,15 +235,39 @@ class Terminal(Circuit):
         return self._is_constant
     
 
+# Constants are always shared: there is a single live Constant node per value.
+# Values are keyed with their type so that 1, 1.0 and True stay apart, and the
+# table only holds weak references so constants no longer used drop out of it.
+_constants = weakref.WeakValueDictionary()
+
+def _constant_key(value):
+    return (type(value), value)
+
 class Constant(Terminal):
+    __slots__ = ('_value',)
+
+    def __new__(cls, value):
+        key = _constant_key(value)
+        constant = _constants.get(key)
+        if constant is None:
+            constant = super(Constant, cls).__new__(cls)
+            _constants[key] = constant
+        return constant
+
     def __init__(self, value):
+        if hasattr(self, '_value'):
+            return
         super(Constant, self).__init__(True)
         self._value = value
+        self._fingerprint = hash(('constant', value))
 
     @property
     def value(self):
         return self._value
 
+    def __reduce__(self):
+        return (Constant, (self._value,))
+
     def __mul__(self, other):
         if self.value == 0:
             return self
@@ -78,164 +281,357 @@ class Constant(Terminal):
         return super(Constant, self).__add__(other)
 
 class Input(Terminal):
+    __slots__ = ('_name',)
+
+    def __new__(cls, name):
+        if not _interning:
+            return super(Input, cls).__new__(cls)
+        return _intern(cls, ('input', name))
+
     def __init__(self, name):
+        if hasattr(self, '_name'):
+            return
         super(Input, self).__init__(False)
         self._name = name
+        self._fingerprint = hash(('input', name))
 
     @property
     def name(self):
         return self._name
 
+    def __reduce__(self):
+        return (Input, (self._name,))
 
-def eval_circuit(circ, input_map, map_constant, eval_map={}):
-    if circ in eval_map:
-        return eval_map[circ]
 
-    if circ.is_terminal:
-        if circ.is_constant:
-            value = map_constant(circ.value)
-            eval_map[circ] = value
-            return value
-        if circ.name not in input_map:
-            raise Exception('Input not found in input map')
-        eval_map[circ] = input_map[circ.name]
-        return input_map[circ.name]
-    elif circ.gate_type is Gate.ADD or circ.gate_type is Gate.MUL:
-        left = eval_circuit(circ.left, input_map, map_constant, eval_map)
-        right = eval_circuit(circ.right, input_map, map_constant, eval_map)
-        
-        if circ.gate_type == Gate.ADD:
-            s = left + right
-            eval_map[circ] = s 
-            return s
-        elif circ.gate_type == Gate.MUL:
-            p = left * right
-            eval_map[circ] = p
-            return p
-        else:
-            raise Exception('Unknown gate type')
-    else:
-        value = eval_circuit(circ.left, input_map, map_constant, eval_map)
-        if circ.gate_type is Gate.SHIFT_LEFT:
-            value <<= circ.right
-        else:
-            value >>= circ.right
-        eval_map[circ] = value
-        return value        
-        
+# Caches
 
-def construct_mul_tree(operands):
-    in_operands = operands
-    out_operands = []
+_missing = object()
 
-    depths = {}
+# Memo for circuit passes that outlives a single run. Entries are keyed on
+# circuit nodes through weak references, so a cache never keeps a circuit
+# alive, and values that are themselves circuit nodes are held weakly too, so
+# cached results are dropped with the last reference to them. The cache can
+# also be bounded to the maxsize most recently used entries. Any pass that
+# takes a cache argument can share one between runs; without one, each run
+# uses a private memo that is dropped when it returns.
+# Entries are kept apart by scope: passes store their results under their own
+# name and any parameters the results depend on, so passes sharing a cache
+# never see each other's values.
+class Cache(object):
+    def __init__(self, maxsize=None):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
 
-    for circ in in_operands:
-        depths[circ] = compute_depth(circ)
-        
-    in_operands.sort(key=lambda x: depths[x])
-
-    while len(in_operands) >= 2:
-        while len(in_operands) != 0:
-            if len(in_operands) >= 2:
-                left = in_operands[0]
-                right = in_operands[1]
-                gate = Gate(Gate.MUL, left, right)
-                out_operands.append(gate)
-                in_operands = in_operands[2:]
-            else:
-                out_operands.append(in_operands[0])
-                in_operands = in_operands[1:]
-        in_operands = out_operands
-        out_operands = []
-    circ = in_operands[0]
+    @property
+    def maxsize(self):
+        return self._maxsize
 
-    return circ
+    @property
+    def hits(self):
+        return self._hits
 
+    @property
+    def misses(self):
+        return self._misses
 
-def reduce_depth(circ, reduced={}, mulchain=False, operands=[]):
-    if circ in reduced and not mulchain:
-        return reduced[circ]
-
-    if not circ.is_terminal and circ.gate_type is Gate.MUL:
-        if not mulchain:
-            mul_operands = []
-            reduce_depth(circ.left, reduced, True, mul_operands)
-            reduce_depth(circ.right, reduced, True, mul_operands)
-
-            noperands = len(mul_operands)
-            for i in range(noperands):
-                mul_operands[i] = reduce_depth(mul_operands[i],
-                                               reduced)
-		marked = set()
-		mul_operands_new = []
-		for i in range(noperands):
-                    if i not in marked:
-                        mul_operands_new.append(mul_operands[i])
-		    for j in range(i + 1, noperands):
-			if compare_circuits(mul_operands[i], mul_operands[j]):
-                            marked.add(j)
-						
-            new_circ = construct_mul_tree(mul_operands_new)
-            if compute_depth(circ) < compute_depth(new_circ):
-                reduced[circ] = circ
-                return circ
-            else:
-                reduced[circ] = new_circ
-                return new_circ
-        else:
-            reduce_depth(circ.left, reduced, mulchain, operands)
-            reduce_depth(circ.right, reduced, mulchain, operands)
-    elif mulchain:
-        operands.append(circ)
-    elif not circ.is_terminal:
-        left = reduce_depth(circ.left, reduced)
-        if circ.gate_type is Gate.ADD:
-            right = reduce_depth(circ.right, reduced)
+    @property
+    def evictions(self):
+        return self._evictions
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self._hits,
+                'misses': self._misses, 'evictions': self._evictions}
+
+    def _expire(self, key, ref):
+        entry = self._entries.get(key)
+        if entry is not None and (entry[0] is ref or entry[1] is ref):
+            del self._entries[key]
+
+    def get(self, node, default=None, scope=None):
+        key = (scope, id(node))
+        entry = self._entries.get(key)
+        if entry is None or entry[0]() is not node:
+            self._misses += 1
+            return default
+        value = entry[1]
+        if entry[2]:
+            value = value()
+            if value is None:
+                self._misses += 1
+                return default
+        self._hits += 1
+        if self._maxsize is not None:
+            del self._entries[key]
+            self._entries[key] = entry
+        return value
+
+    def __contains__(self, node):
+        return self.get(node, _missing) is not _missing
+
+    def __getitem__(self, node):
+        value = self.get(node, _missing)
+        if value is _missing:
+            raise KeyError(node)
+        return value
+
+    def __setitem__(self, node, value):
+        self.set(node, value)
+
+    def set(self, node, value, scope=None):
+        key = (scope, id(node))
+        if key in self._entries:
+            del self._entries[key]
+        expire = lambda ref, key=key: self._expire(key, ref)
+        ref = weakref.ref(node, expire)
+        if isinstance(value, Circuit):
+            self._entries[key] = (ref, weakref.ref(value, expire), True)
         else:
-            right = circ.right
-        gate = Gate(circ.gate_type, left, right)
-        reduced[circ] = gate
-        return gate
-        
-    else:
-        reduced[circ] = circ
-    return circ
+            self._entries[key] = (ref, value, False)
+        if self._maxsize is not None and len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+# The values computed during one run of a pass. Values found in or added to
+# the backing cache are also held here, so entries the cache evicts while the
+# pass is running remain available until it returns.
+class _RunMemo(object):
+    def __init__(self, cache, scope):
+        self._values = {}
+        self._cache = cache
+        self._scope = scope
+
+    def __contains__(self, node):
+        if node in self._values:
+            return True
+        value = self._cache.get(node, _missing, self._scope)
+        if value is _missing:
+            return False
+        self._values[node] = value
+        return True
 
-def expand(circ, exp={}):
-    if circ in exp:
-        return exp[circ]
+    def __getitem__(self, node):
+        return self._values[node]
 
-    if circ.is_terminal:
-        exp[circ] = circ
-        return circ
+    def __setitem__(self, node, value):
+        self._values[node] = value
+        self._cache.set(node, value, self._scope)
 
-    if circ.gate_type is not Gate.MUL:
-        exp_circ = Gate(circ.gate_type, expand(circ.left, exp),
-                        expand(circ.right, exp))
-        exp[circ] = exp_circ
-        return exp_circ
+# A dict given in place of a cache is a memo the caller keeps for this pass
+# alone, such as the depth memo threaded through reduce_depth, and is used
+# directly
+def _memo(cache, scope):
+    if cache is None:
+        return {}
+    if not isinstance(cache, Cache):
+        return cache
+    return _RunMemo(cache, scope)
 
-    left = expand(circ.left, exp)
-    right = expand(circ.right, exp)
-    exp_circ = insert_mul(left, right)
-    exp[circ] = exp_circ
-    return exp_circ
+
+# Traversal
+
+def children(circ):
+    if circ.is_terminal:
+        return ()
+    if is_unary(circ):
+        return (circ.left,)
+    return (circ.left, circ.right)
+
+# Generates the nodes reachable from roots in post-order (children before
+# parents, each node once) using an explicit stack, so deep circuits do not hit
+# the recursion limit. Nodes in done are neither yielded nor descended into,
+# which lets a pass skip everything already in its memo. The children function
+# can be replaced to walk a pass-specific view of the circuit. Roots must be
+# circuit nodes; other objects with the same operators, such as the handles of
+# stream.Builder, are rejected rather than mistaken for terminals.
+def postorder(roots, done=(), children=children):
+    if isinstance(roots, Circuit):
+        roots = [roots]
+    visited = set()
+    for root in roots:
+        if not isinstance(root, Circuit):
+            raise Exception('Not a circuit node: %r' % (root,))
+        if root in done or root in visited:
+            continue
+        visited.add(root)
+        stack = [(root, iter(children(root)))]
+        while len(stack) != 0:
+            node, pending = stack[-1]
+            for child in pending:
+                if child not in visited and child not in done:
+                    visited.add(child)
+                    stack.append((child, iter(children(child))))
+                    break
+            else:
+                stack.pop()
+                yield node
+
+# Passes take a circuit or a list of circuits, processing the union of the
+# circuits once so that structure shared between them stays shared, and return
+# the result for the circuit or a list with the result for each circuit
+def _results(circ, memo):
+    if isinstance(circ, Circuit):
+        return memo[circ]
+    return [memo[root] for root in circ]
+
+# Number of gates using each node
+def fanout(roots):
+    counts = {}
+    for node in postorder(roots):
+        for child in children(node):
+            counts[child] = counts.get(child, 0) + 1
+    return counts
+
+def _sum_children(circ):
+    if circ.is_terminal or circ.gate_type is not Gate.ADD:
+        return ()
+    return (circ.left, circ.right)
+
+def _product_children(circ):
+    if circ.is_terminal:
+        return ()
+    if circ.gate_type is Gate.MUL:
+        return build_mul_operands(circ)
+    return children(circ)
+
+
+# Values depend on the input map as well as the circuit, so evaluation takes
+# no cache. An observer, if given, is called as observer.gate(node, start,
+# elapsed) after each gate is evaluated, with the start time and the time
+# taken in seconds.
+def eval_circuit(circ, input_map, map_constant, observer=None):
+    return _results(circ, eval_nodes(circ, input_map, map_constant, observer))
+
+# Returns a dict with the value of every node reachable from circ
+def eval_nodes(circ, input_map, map_constant, observer=None):
+    eval_map = {}
+    for node in postorder(circ, eval_map):
+        if node.is_terminal:
+            if node.is_constant:
+                value = map_constant(node.value)
+            elif node.name not in input_map:
+                raise Exception('Input not found in input map')
+            else:
+                value = input_map[node.name]
+            eval_map[node] = value
+            continue
+
+        if observer is not None:
+            start = time.time()
+        if node.gate_type is Gate.ADD:
+            value = eval_map[node.left] + eval_map[node.right]
+        elif node.gate_type is Gate.MUL:
+            value = eval_map[node.left] * eval_map[node.right]
+        elif node.gate_type is Gate.SHIFT_LEFT:
+            value = eval_map[node.left] << node.right
+        elif node.gate_type is Gate.SHIFT_RIGHT:
+            value = eval_map[node.left] >> node.right
+        elif node.gate_type is Gate.MOD_SWITCH:
+            value = mod_switch_value(eval_map[node.left], node.right)
+        else:
+            raise Exception('Unknown gate type')
+        if observer is not None:
+            observer.gate(node, start, time.time() - start)
+        eval_map[node] = value
+    return eval_map
+
+
+# Builds a product of the operands with minimal multiplicative depth by
+# repeatedly multiplying the two shallowest operands, as in Huffman coding.
+# Ties are broken on fingerprints, so the same operands always give the same
+# tree and repeated products can be shared by deduplicate or interning.
+def construct_mul_tree(operands, depths=None):
+    if len(operands) == 0:
+        raise Exception('No operands to multiply')
+    if depths is None:
+        depths = {}
+
+    heap = []
+    for i, circ in enumerate(operands):
+        heap.append((compute_depth(circ, depths), circ.fingerprint, i, circ))
+    heapq.heapify(heap)
+
+    count = len(heap)
+    while len(heap) >= 2:
+        left = heapq.heappop(heap)[3]
+        right = heapq.heappop(heap)[3]
+        gate = Gate(Gate.MUL, left, right)
+        heapq.heappush(heap, (compute_depth(gate, depths), gate.fingerprint,
+                              count, gate))
+        count += 1
+
+    return heap[0][3]
+
+
+# Each chain of MUL gates is treated as one node whose children are the
+# operands of the chain, so the operands are reduced before the chain is
+# rebuilt as a balanced tree
+def reduce_depth(circ, cache=None, depths=None):
+    reduced = _memo(cache, 'reduce_depth')
+    if depths is None:
+        depths = {}
+    for node in postorder(circ, reduced, _product_children):
+        if node.is_terminal:
+            new_node = node
+        elif node.gate_type is Gate.MUL:
+            mul_operands = [reduced[operand]
+                            for operand in build_mul_operands(node)]
+            with _replacing(node):
+                new_circ = construct_mul_tree(unique_operands(mul_operands),
+                                              depths)
+            if compute_depth(node, depths) < compute_depth(new_circ, depths):
+                new_node = node
+            else:
+                new_node = new_circ
+        elif is_unary(node):
+            new_node = Gate(node.gate_type, reduced[node.left], node.right)
+        else:
+            new_node = Gate(node.gate_type, reduced[node.left],
+                            reduced[node.right])
+        reduced[node] = _inherit_tag(new_node, node)
+    return _results(circ, reduced)
+
+def expand(circ, cache=None):
+    exp = _memo(cache, 'expand')
+    for node in postorder(circ, exp):
+        if node.is_terminal:
+            exp_circ = node
+        elif node.gate_type is Gate.MUL:
+            exp_circ = insert_mul(exp[node.left], exp[node.right])
+        elif is_unary(node):
+            exp_circ = Gate(node.gate_type, exp[node.left], node.right)
+        else:
+            exp_circ = Gate(node.gate_type, exp[node.left], exp[node.right])
+        exp[node] = exp_circ
+    return _results(circ, exp)
 
 
 def is_product(circ):
     return circ.is_terminal or circ.gate_type is Gate.MUL
 
-def insert_mul(multiplier, circ):
-    if is_product(circ):
-        if is_product(multiplier):
-            return Gate(Gate.MUL, multiplier, circ)
+# Rebuilds the tree of ADD gates at the top of circ, replacing each addend
+# (any node that is not an ADD gate) by f(addend)
+def map_addends(circ, f):
+    mapped = {}
+    for node in postorder(circ, mapped, _sum_children):
+        if node.is_terminal or node.gate_type is not Gate.ADD:
+            mapped[node] = f(node)
         else:
-            return insert_mul(circ, multiplier)
-    elif not circ.is_terminal and circ.gate_type is Gate.ADD:
-        return Gate(circ.gate_type, insert_mul(multiplier, circ.left),
-                    insert_mul(multiplier, circ.right))
-    return circ
+            mapped[node] = Gate(Gate.ADD, mapped[node.left],
+                                mapped[node.right])
+    return mapped[circ]
+
+def insert_mul(multiplier, circ):
+    return map_addends(circ, lambda term: map_addends(
+        multiplier, lambda factor: Gate(Gate.MUL, factor, term)))
 
 def distribute(circ):
     if circ.is_terminal:
@@ -264,172 +660,936 @@ def distribute(circ):
     return Gate(Gate.ADD, add_left, add_right)
 
 def build_mul_operands(circ):
-    if circ.is_terminal or circ.gate_type != Gate.MUL:
-        return [circ]
-    mul_operands_left = build_mul_operands(circ.left)
-    mul_operands_right = build_mul_operands(circ.right)
-    return mul_operands_left + mul_operands_right
-
-def simplify(circ, simpl={}):
-    if circ in simpl:
-        return simpl[circ]
+    operands = []
+    stack = [circ]
+    while len(stack) != 0:
+        node = stack.pop()
+        if node.is_terminal or node.gate_type is not Gate.MUL:
+            operands.append(node)
+        else:
+            stack.append(node.right)
+            stack.append(node.left)
+    return operands
+
+# The operands of the chain formed by circ and the gates of the same type
+# below it that are not used anywhere else
+def _chain_operands(circ, counts):
+    operands = []
+    stack = [circ.right, circ.left]
+    while len(stack) != 0:
+        node = stack.pop()
+        if node.is_terminal or node.gate_type is not circ.gate_type or \
+           counts.get(node, 0) > 1:
+            operands.append(node)
+        else:
+            stack.append(node.right)
+            stack.append(node.left)
+    return operands
+
+def _sum_addends(circ, counts):
+    return _chain_operands(circ, counts)
+
+# Rebuilds the chain at circ with each operand replaced by its value in
+# mapped, keeping the nodes whose operands are unchanged
+def _rebuild_chain(circ, counts, mapped):
+    def chain_children(node):
+        if node is circ or (not node.is_terminal and
+                            node.gate_type is circ.gate_type and
+                            counts.get(node, 0) <= 1):
+            return (node.left, node.right)
+        return ()
+
+    rebuilt = {}
+    for node in postorder(circ, (), chain_children):
+        if len(chain_children(node)) == 0:
+            rebuilt[node] = mapped[node]
+            continue
+        left = rebuilt[node.left]
+        right = rebuilt[node.right]
+        if left is node.left and right is node.right:
+            rebuilt[node] = node
+        else:
+            rebuilt[node] = _inherit_tag(Gate(node.gate_type, left, right),
+                                         node)
+    return rebuilt[circ]
+
+# Each chain of ADD gates is treated as one n-ary sum whose terms are
+# simplified first and then factored with factor_sum. Nodes are built with
+# interning enabled, so sums factored separately, here or in earlier runs,
+# share the products they have in common. Terms that are also used outside
+# their sum are kept whole, as pulling a factor out of them would add a product
+# without removing one.
+def simplify(circ, cache=None, depths=None, max_depth_increase=0):
+    interning = _interning
+    set_interning(True)
+    try:
+        return _simplify(circ, cache, depths, max_depth_increase)
+    finally:
+        set_interning(interning)
+
+def _simplify(circ, cache, depths, max_depth_increase):
+    simpl = _memo(cache, ('simplify', max_depth_increase))
+    if depths is None:
+        depths = {}
+    counts = fanout(circ)
+    uses = _structural_uses(circ)
+
+    def addend_children(node):
+        if node.is_terminal:
+            return ()
+        if node.gate_type is Gate.ADD:
+            return _sum_addends(node, counts)
+        return children(node)
+
+    for node in postorder(circ, simpl, addend_children):
+        if node.is_terminal:
+            new_node = node
+        elif is_unary(node):
+            new_node = Gate(node.gate_type, simpl[node.left], node.right)
+        elif node.gate_type is not Gate.ADD:
+            new_node = Gate(node.gate_type, simpl[node.left],
+                            simpl[node.right])
+        else:
+            addends = _sum_addends(node, counts)
+            terms = [simpl[addend] for addend in addends]
+            shared = set(simpl[addend] for addend in addends
+                         if uses.get(addend.fingerprint, 0) > 1)
+            with _replacing(node):
+                new_node = factor_sum(terms, depths, max_depth_increase,
+                                      shared)
+        simpl[node] = _inherit_tag(new_node, node)
+    return _results(circ, simpl)
+
+# Number of uses of each node, by fingerprint, where outputs count as uses and
+# structurally identical nodes are counted once
+def _structural_uses(roots):
+    uses = {}
+    seen = set()
+    for node in postorder(roots):
+        if node.fingerprint in seen:
+            continue
+        seen.add(node.fingerprint)
+        for child in children(node):
+            uses[child.fingerprint] = uses.get(child.fingerprint, 0) + 1
+    if not isinstance(roots, Circuit):
+        for fp in set(root.fingerprint for root in roots):
+            uses[fp] = uses.get(fp, 0) + 1
+    return uses
+
+# Factors a sum of products by greedily pulling out the factor common to the
+# most terms, e.g. a*b + a*c + b*c becomes a*(b + c) + b*c, and factoring the
+# quotients and the remaining terms in the same way. Only the two operands of a
+# product are used as its factors, and the terms in shared are not divided at
+# all, so products shared with other parts of the circuit are reused rather
+# than rebuilt. A factoring is only used if it does not make the sum more than
+# max_depth_increase deeper.
+def factor_sum(terms, depths=None, max_depth_increase=0, shared=()):
+    if depths is None:
+        depths = {}
+    max_depth = max(compute_depth(term, depths) for term in terms) + \
+        max_depth_increase
+    return _factor_terms([(term, [term] if term in shared
+                           else _term_factors(term)) for term in terms],
+                         depths, max_depth)
+
+def _term_factors(term):
+    if term.is_terminal or term.gate_type is not Gate.MUL:
+        return [term]
+    return [term.left, term.right]
+
+# Terms are pairs of a node, or None if the product has not been built yet,
+# and its list of factors
+def _build_term(term, depths):
+    node, factors = term
+    if node is not None:
+        return node
+    if len(factors) == 0:
+        return Constant(1)
+    return construct_mul_tree(factors, depths)
+
+def _sum_terms(terms, depths):
+    circ = None
+    for term in terms:
+        node = _build_term(term, depths)
+        if circ is None:
+            circ = node
+        else:
+            circ = Gate(Gate.ADD, circ, node)
+    return circ
 
-    if circ.is_terminal:
-        simpl[circ] = circ
+# The state of factoring one list of terms. Divisors are tried in order of
+# decreasing occurrence count, ties going to the factor that appears first,
+# and the counts are kept up to date as the terms divided by a chosen divisor
+# are removed. The heap holds (-count, term, position, fingerprint) entries,
+# which are corrected when popped since counts only decrease and first
+# appearances only move later as terms are removed.
+class _FactorFrame(object):
+    __slots__ = ('terms', 'alive', 'counts', 'index', 'first', 'heap',
+                 'failed', 'products', 'pending')
+
+    def __init__(self, terms):
+        self.terms = terms
+        self.alive = [True] * len(terms)
+        self.counts = {}
+        self.index = {}
+        for i, term in enumerate(terms):
+            for pos, factor in enumerate(unique_operands(term[1])):
+                fp = factor.fingerprint
+                self.counts[fp] = self.counts.get(fp, 0) + 1
+                self.index.setdefault(fp, []).append((i, pos, factor))
+        self.first = dict((fp, 0) for fp in self.index)
+        self.heap = [(-count, self.index[fp][0][0], self.index[fp][0][1], fp)
+                     for fp, count in self.counts.iteritems() if count >= 2]
+        heapq.heapify(self.heap)
+        self.failed = []
+        self.products = []
+        self.pending = None
+
+    def _entry(self, fp):
+        occurrences = self.index[fp]
+        k = self.first[fp]
+        while not self.alive[occurrences[k][0]]:
+            k += 1
+        self.first[fp] = k
+        return (-self.counts[fp], occurrences[k][0], occurrences[k][1], fp)
+
+    # Pops the next divisor to try, returning its heap entry and node
+    def next_divisor(self):
+        while len(self.heap) != 0:
+            entry = heapq.heappop(self.heap)
+            fp = entry[3]
+            if self.counts[fp] < 2:
+                continue
+            current = self._entry(fp)
+            if current != entry:
+                heapq.heappush(self.heap, current)
+                continue
+            return entry, self.index[fp][self.first[fp]][2]
+        return None
+
+    # The indexes of the remaining terms with the divisor as a factor
+    def members(self, fp):
+        return [i for i, pos, factor in self.index[fp][self.first[fp]:]
+                if self.alive[i]]
+
+    def remove(self, members):
+        for i in members:
+            self.alive[i] = False
+            for factor in unique_operands(self.terms[i][1]):
+                self.counts[factor.fingerprint] -= 1
+        for entry in self.failed:
+            heapq.heappush(self.heap, entry)
+        self.failed = []
+
+    # The sum of the products pulled out and the remaining terms, nested as
+    # product + (product + (... + rest))
+    def result(self, depths):
+        rest = [term for i, term in enumerate(self.terms) if self.alive[i]]
+        circ = None
+        if len(rest) != 0:
+            circ = _sum_terms(rest, depths)
+        for product in reversed(self.products):
+            circ = product if circ is None else Gate(Gate.ADD, product, circ)
         return circ
 
-    if circ.gate_type is not Gate.ADD:
-        circ_simpl = Gate(circ.gate_type, simplify(circ.left, simpl),
-                          simplify(circ.right, simpl))
-        simpl[circ] = circ_simpl
-        return circ_simpl
-
-    left = simplify(circ.left)
-    right = simplify(circ.right)
-
-    if left.is_terminal or left.gate_type is not Gate.MUL or right.is_terminal \
-       or right.gate_type is not Gate.MUL:
-        circ_simpl = Gate(circ.gate_type, left,
-                          right)
-        simpl[circ] = circ_simpl
-        return circ_simpl
-
-    left_mul_operands = build_mul_operands(left)
-    right_mul_operands = build_mul_operands(right)
-
-    marked = set()
-    new_left_mul_operands = []
-    new_right_mul_operands = []
-    common_operands = []
-
-    for operand in left_mul_operands:
-        matched = False
-        for i in range(len(right_mul_operands)):
-            if compare_circuits(operand, right_mul_operands[i]):
-                marked.add(i)
-                common_operands.append(operand)
-                matched = True
-        if not matched:
-            new_left_mul_operands.append(operand)
-
-    for i in range(len(right_mul_operands)):
-        if i not in marked:
-            new_right_mul_operands.append(right_mul_operands[i])
-
-    if len(new_left_mul_operands) == 0:
-        left = Constant(1)
-    else:
-        left = simplify(construct_mul_tree(new_left_mul_operands), simpl)
-
-    if len(new_right_mul_operands) == 0:
-        right = Constant(1)
-    else:
-        right = simplify(construct_mul_tree(new_right_mul_operands), simpl)
-    common_tree = simplify(construct_mul_tree(common_operands), simpl)
-    add_gate = Gate(Gate.ADD, left, right)
-    mul_gate = Gate(Gate.MUL, add_gate, common_tree)
-    simpl[circ] = mul_gate
+# Factoring a divisor out of some terms recurses on the quotients, so the
+# frames of the quotient lists being factored are kept on an explicit stack
+def _factor_terms(terms, depths, max_depth):
+    stack = [_FactorFrame(terms)]
+    result = None
+    while len(stack) != 0:
+        frame = stack[-1]
+        if frame.pending is not None:
+            entry, divisor, members = frame.pending
+            frame.pending = None
+            product = Gate(Gate.MUL, divisor, result)
+            if compute_depth(product, depths) > max_depth:
+                frame.failed.append(entry)
+            else:
+                frame.products.append(product)
+                frame.remove(members)
+
+        chosen = frame.next_divisor()
+        if chosen is None:
+            result = frame.result(depths)
+            stack.pop()
+            continue
+        entry, divisor = chosen
+        members = frame.members(entry[3])
+        quotients = []
+        for i in members:
+            factors = frame.terms[i][1]
+            for j in range(len(factors)):
+                if factors[j].fingerprint == divisor.fingerprint:
+                    quotients.append((None, factors[:j] + factors[j + 1:]))
+                    break
+        frame.pending = (entry, divisor, members)
+        stack.append(_FactorFrame(quotients))
+    return result
+
+
+# Rebuilds the circuit so that structurally identical subcircuits (up to
+# commutativity of ADD and MUL) are represented by a single node. Canonical
+# nodes are looked up in a table keyed on the identities of their (already
+# canonical) children, so this is a single linear pass. Passing the same cache
+# and table to several runs shares canonical nodes between them.
+def deduplicate(circ, cache=None, table=None):
+    subcircs = _memo(cache, 'deduplicate')
+    if table is None:
+        table = {}
+    for node in postorder(circ, subcircs):
+        if node.is_terminal:
+            key = _terminal_key(node)
+            left = right = None
+        else:
+            left = subcircs[node.left]
+            if is_unary(node):
+                right = node.right
+            else:
+                right = subcircs[node.right]
+            key = _gate_key(node.gate_type, left, right)
 
-    return mul_gate
+        canonical = table.get(key)
+        if canonical is None:
+            if node.is_terminal or (left is node.left and right is node.right):
+                canonical = node
+            else:
+                canonical = _inherit_tag(Gate(node.gate_type, left, right),
+                                         node)
+            table[key] = canonical
+        subcircs[node] = canonical
+    return _results(circ, subcircs)
+
+def build_add_operands(circ):
+    operands = []
+    stack = [circ]
+    while len(stack) != 0:
+        node = stack.pop()
+        if node.is_terminal or node.gate_type is not Gate.ADD:
+            operands.append(node)
+        else:
+            stack.append(node.right)
+            stack.append(node.left)
+    return operands
+
+def _gf2_constant(circ):
+    return circ.is_terminal and circ.is_constant and \
+        isinstance(circ.value, (int, long))
+
+# Products are identified by their set of factors, so (a*b)*c and (a*c)*b
+# cancel in a sum
+def _product_key(circ):
+    if circ.is_terminal or circ.gate_type is not Gate.MUL:
+        return circ.fingerprint
+    return frozenset(operand.fingerprint
+                     for operand in build_mul_operands(circ))
+
+# The operands of a chain are flattened further where they are themselves
+# (normalized, shared) products or sums, so that factors and addends are
+# collected across shared nodes as well
+def _normalize_product(operands, depths):
+    factors = []
+    for operand in operands:
+        factors.extend(build_mul_operands(operand))
+    changed = False
+    unique = []
+    seen = set()
+    for factor in factors:
+        if _gf2_constant(factor):
+            if factor.value % 2 == 0:
+                return Constant(0)
+            changed = True
+        elif factor.fingerprint in seen:
+            changed = True
+        else:
+            seen.add(factor.fingerprint)
+            unique.append(factor)
+    if not changed:
+        return None
+    if len(unique) == 0:
+        return Constant(1)
+    return construct_mul_tree(unique, depths)
+
+def _normalize_sum(operands):
+    addends = []
+    for operand in operands:
+        addends.extend(build_add_operands(operand))
+    changed = False
+    parity = 0
+    nconstants = 0
+    counts = {}
+    for addend in addends:
+        if _gf2_constant(addend):
+            parity ^= addend.value % 2
+            nconstants += 1
+            changed = changed or nconstants > 1 or addend.value % 2 == 0
+        else:
+            key = _product_key(addend)
+            if key in counts:
+                changed = True
+            counts[key] = counts.get(key, 0) + 1
+    if not changed:
+        return None
+
+    circ = None
+    for addend in addends:
+        if _gf2_constant(addend):
+            continue
+        key = _product_key(addend)
+        if counts.get(key, 0) % 2 == 1:
+            circ = addend if circ is None else Gate(Gate.ADD, circ, addend)
+        counts.pop(key, None)
+    if parity == 1:
+        circ = Constant(1) if circ is None else Gate(Gate.ADD, circ,
+                                                     Constant(1))
+    if circ is None:
+        return Constant(0)
+    return circ
 
+# Normal form for circuits over rings of characteristic 2 such as GF(2). Chains
+# of ADD and MUL gates are flattened, products are made idempotent (x*x = x),
+# addends cancel in pairs (x + x = 0) and integer constants are folded. As in
+# simplify, each chain of gates not used elsewhere is normalized once at its
+# head, so the work is linear in the length of the chain. Nodes that none of
+# these apply to are kept as they are to preserve sharing.
+def normalize_gf2(circ, cache=None, depths=None):
+    norm = _memo(cache, 'normalize_gf2')
+    if depths is None:
+        depths = {}
+    counts = fanout(circ)
+
+    def operand_children(node):
+        if node.is_terminal or is_unary(node):
+            return children(node)
+        return _chain_operands(node, counts)
+
+    for node in postorder(circ, norm, operand_children):
+        if node.is_terminal:
+            if _gf2_constant(node):
+                norm[node] = Constant(node.value % 2)
+            else:
+                norm[node] = node
+            continue
 
-def deduplicate(circ, subcircs=set()):
-    if circ in subcircs:
+        if is_unary(node):
+            left = norm[node.left]
+            if left is node.left:
+                new_node = node
+            else:
+                new_node = Gate(node.gate_type, left, node.right)
+            norm[node] = _inherit_tag(new_node, node)
+            continue
+
+        operands = _chain_operands(node, counts)
+        with _replacing(node):
+            if node.gate_type is Gate.MUL:
+                new_node = _normalize_product([norm[operand]
+                                               for operand in operands],
+                                              depths)
+            else:
+                new_node = _normalize_sum([norm[operand]
+                                           for operand in operands])
+        if new_node is None:
+            new_node = _rebuild_chain(node, counts, norm)
+        norm[node] = _inherit_tag(new_node, node)
+    return _results(circ, norm)
+
+# Constant folding. Constant values are integers, or tuples giving the values
+# of the first slots of a slot vector with the remaining slots zero. Shifts are
+# rotations, so an integer constant (the same value in every slot) is unchanged
+# by a shift, and a tuple constant can only be rotated if the number of slots
+# is known.
+
+def _is_constant(circ):
+    return circ.is_terminal and circ.is_constant
+
+def _is_zero(value):
+    if isinstance(value, tuple):
+        return not any(value)
+    return value == 0
+
+def _fold_values(gate_type, left, right, modulus):
+    if gate_type is Gate.ADD:
+        op = lambda x, y: x + y
+    else:
+        op = lambda x, y: x * y
+    if isinstance(left, tuple) or isinstance(right, tuple):
+        if not isinstance(left, tuple):
+            if gate_type is Gate.ADD:
+                return None
+            left = (left,) * len(right)
+        elif not isinstance(right, tuple):
+            if gate_type is Gate.ADD:
+                return None
+            right = (right,) * len(left)
+        n = max(len(left), len(right))
+        left = left + (0,) * (n - len(left))
+        right = right + (0,) * (n - len(right))
+        value = tuple(op(x, y) for x, y in zip(left, right))
+        if modulus is not None:
+            value = tuple(x % modulus for x in value)
+        return value
+    value = op(left, right)
+    if modulus is not None:
+        value %= modulus
+    return value
+
+def _rotate(value, num_places, nslots):
+    if len(value) > nslots:
+        raise Exception('Constant has more values than slots')
+    value = value + (0,) * (nslots - len(value))
+    num_places %= nslots
+    return value[num_places:] + value[:num_places]
+
+# Returns the folded node for a gate with the given operands, or None if the
+# gate cannot be folded
+def fold_gate(gate_type, left, right, modulus=None, nslots=None):
+    if gate_type is Gate.MOD_SWITCH:
+        # constants are plaintexts, which can be encoded at any level
+        if right == 0 or _is_constant(left):
+            return left
+        return None
+    if is_shift_type(gate_type):
+        if right == 0 or (nslots is not None and right % nslots == 0):
+            return left
+        if not _is_constant(left):
+            return None
+        if not isinstance(left.value, tuple) or _is_zero(left.value):
+            return left
+        if nslots is None:
+            return None
+        if gate_type is Gate.SHIFT_RIGHT:
+            right = -right
+        return Constant(_rotate(left.value, right, nslots))
+
+    left_constant = _is_constant(left)
+    right_constant = _is_constant(right)
+    if left_constant and right_constant:
+        value = _fold_values(gate_type, left.value, right.value, modulus)
+        if value is not None:
+            return Constant(value)
+    if gate_type is Gate.ADD:
+        if left_constant and _is_zero(left.value):
+            return right
+        if right_constant and _is_zero(right.value):
+            return left
+    elif gate_type is Gate.MUL:
+        if (left_constant and _is_zero(left.value)) or \
+           (right_constant and _is_zero(right.value)):
+            return Constant(0)
+        if left_constant and left.value == 1:
+            return right
+        if right_constant and right.value == 1:
+            return left
+    return None
+
+def fold_constants(circ, cache=None, modulus=None, nslots=None):
+    folded = _memo(cache, ('fold_constants', modulus, nslots))
+    _fold_circuit(circ, folded, {}, modulus, nslots)
+    return _results(circ, folded)
+
+# Folds constants in the circuits reachable from roots, first replacing the
+# inputs named in known_inputs by constants with the given values
+def _fold_circuit(roots, folded, known_inputs, modulus, nslots):
+    for node in postorder(roots, folded):
+        if node.is_terminal:
+            new_node = node
+            if not node.is_constant and node.name in known_inputs:
+                new_node = Constant(known_inputs[node.name])
+            if new_node.is_constant and modulus is not None and \
+               isinstance(new_node.value, (int, long)):
+                new_node = Constant(new_node.value % modulus)
+        else:
+            left = folded[node.left]
+            if is_unary(node):
+                right = node.right
+            else:
+                right = folded[node.right]
+            new_node = fold_gate(node.gate_type, left, right, modulus, nslots)
+            if new_node is None:
+                if left is node.left and right is node.right:
+                    new_node = node
+                else:
+                    new_node = Gate(node.gate_type, left, right)
+        folded[node] = _inherit_tag(new_node, node)
+
+# Partial evaluation: replaces the inputs named in known_inputs by constants
+# with the given values and folds the result. Returns the residual circuit (or
+# list of circuits) together with statistics on the gates dropped and the
+# depth before and after.
+def specialize(circ, known_inputs, modulus=None, nslots=None):
+    roots = [circ] if isinstance(circ, Circuit) else circ
+    spec = {}
+    _fold_circuit(roots, spec, known_inputs, modulus, nslots)
+
+    residual = [spec[root] for root in roots]
+    before = count_gates_by_type(roots)
+    after = count_gates_by_type(residual)
+    depths = {}
+    stats = {
+        'gates_before': sum(before.values()),
+        'gates_after': sum(after.values()),
+        'dropped': dict((GATE_NAMES[t], before[t] - after.get(t, 0))
+                        for t in before),
+        'depth_before': max(compute_depth(root, depths) for root in roots),
+        'depth_after': max(compute_depth(root, depths) for root in residual),
+    }
+    if isinstance(circ, Circuit):
+        return residual[0], stats
+    return residual, stats
+
+# Rotations. Shift gates are slot rotations, so a shift of a shift is a single
+# rotation by the summed amount, taken modulo the number of slots when known.
+# Amounts are signed, with left shifts positive.
+
+def _shift_amount(circ):
+    if circ.gate_type is Gate.SHIFT_LEFT:
+        return circ.right
+    return -circ.right
+
+def _normalize_amount(amount, nslots):
+    if nslots is not None:
+        amount %= nslots
+    return amount
+
+def _rotate_node(circ, amount, nslots, table, merge=True):
+    if merge and is_shift(circ):
+        amount += _shift_amount(circ)
+        circ = circ.left
+    amount = _normalize_amount(amount, nslots)
+    if amount == 0:
         return circ
-
-    for sc in subcircs:
-        if compare_circuits(circ, sc):
-            return sc
-
-    if not circ.is_terminal:
-        circ = Gate(circ.gate_type, deduplicate(circ.left, subcircs),
-                    deduplicate(circ.right, subcircs))
-
-    subcircs.add(circ)
-    return circ
+    if _is_constant(circ) and not isinstance(circ.value, tuple):
+        return circ
+    key = (id(circ), amount)
+    node = table.get(key)
+    if node is None:
+        if amount > 0:
+            node = Gate(Gate.SHIFT_LEFT, circ, amount)
+        else:
+            node = Gate(Gate.SHIFT_RIGHT, circ, -amount)
+        table[key] = node
+    return node
+
+def _free_rotation(circ, counts):
+    return is_shift(circ) and counts.get(circ, 0) == 1 or \
+        _is_constant(circ) and not isinstance(circ.value, tuple)
+
+# Reduces the number of rotations. A shift of a shift used nowhere else is
+# merged into one rotation, a shift of a sum of such shifts is distributed over
+# the sum (rot(rot(x, a) + rot(y, b), k) = rot(x, a + k) + rot(y, b + k)), a
+# sum of two such shifts by the same amount is rotated once
+# (rot(x, k) + rot(y, k) = rot(x + y, k)), and rotations of the same value by
+# the same amount are shared. With nslots given, every rotation is a left
+# shift by an amount less than nslots.
+def merge_rotations(circ, nslots=None, cache=None):
+    merged = _memo(cache, ('merge_rotations', nslots))
+    counts = fanout(circ)
+    table = {}
+    for node in postorder(circ, merged):
+        if node.is_terminal:
+            new_node = node
+        elif is_shift(node):
+            amount = _shift_amount(node)
+            inner = node.left
+            if not inner.is_terminal and inner.gate_type is Gate.ADD and \
+               counts.get(inner, 0) == 1 and \
+               _free_rotation(inner.left, counts) and \
+               _free_rotation(inner.right, counts):
+                new_node = Gate(Gate.ADD,
+                                _rotate_node(merged[inner.left], amount,
+                                             nslots, table),
+                                _rotate_node(merged[inner.right], amount,
+                                             nslots, table))
+            else:
+                new_node = _rotate_node(merged[inner], amount, nslots, table,
+                                        counts.get(inner, 0) == 1)
+        elif is_unary(node):
+            left = merged[node.left]
+            if left is node.left:
+                new_node = node
+            else:
+                new_node = Gate(node.gate_type, left, node.right)
+        else:
+            left = merged[node.left]
+            right = merged[node.right]
+            if node.gate_type is Gate.ADD and is_shift(left) and \
+               is_shift(right) and counts.get(node.left, 0) == 1 and \
+               counts.get(node.right, 0) == 1 and \
+               _normalize_amount(_shift_amount(left), nslots) == \
+               _normalize_amount(_shift_amount(right), nslots):
+                new_node = _rotate_node(Gate(Gate.ADD, left.left, right.left),
+                                        _shift_amount(left), nslots, table)
+            elif left is node.left and right is node.right:
+                new_node = node
+            else:
+                new_node = Gate(node.gate_type, left, right)
+        merged[node] = _inherit_tag(new_node, node)
+    return _results(circ, merged)
+
+# The number of rotations in the circuit (or list of circuits) and the
+# distinct rotation amounts it needs, e.g. to decide which rotation keys to
+# generate
+def rotation_stats(circ, nslots=None):
+    rotations = 0
+    amounts = set()
+    for node in postorder(circ):
+        if is_shift(node):
+            rotations += 1
+            amounts.add(_normalize_amount(_shift_amount(node), nslots))
+    return {'rotations': rotations, 'amounts': sorted(amounts)}
+
+def is_shift_type(gate_type):
+    return gate_type == Gate.SHIFT_LEFT or gate_type == Gate.SHIFT_RIGHT
 
 def is_shift(circ):
-    return not circ.is_terminal and circ.gate_type is Gate.SHIFT_LEFT or\
-        circ.gate_type is Gate.SHIFT_RIGHT
-        
+    return not circ.is_terminal and is_shift_type(circ.gate_type)
 
-def count_gates(circ,
-                gate_types=set([Gate.ADD, Gate.MUL, Gate.SHIFT_LEFT, Gate.SHIFT_RIGHT]),
-                counted=set([])):
-    if circ in counted or circ.is_terminal:
-        return 0
+# Unary gates have a single circuit operand, with an integer right operand
+def is_unary_type(gate_type):
+    return is_shift_type(gate_type) or gate_type == Gate.MOD_SWITCH
 
-    left_count = count_gates(circ.left, gate_types, counted)
-    if not is_shift(circ):
-        right_count = count_gates(circ.right, gate_types, counted)
-    else:
-        right_count = 0
+def is_unary(circ):
+    return not circ.is_terminal and is_unary_type(circ.gate_type)
+        
 
-    counted.add(circ)
-    count = left_count + right_count
-    if circ.gate_type in gate_types:
-        count += 1
+GATE_NAMES = {Gate.ADD: 'ADD', Gate.MUL: 'MUL', Gate.SHIFT_LEFT: 'SHIFT_LEFT',
+              Gate.SHIFT_RIGHT: 'SHIFT_RIGHT', Gate.MOD_SWITCH: 'MOD_SWITCH'}
+
+ALL_GATE_TYPES = frozenset([Gate.ADD, Gate.MUL, Gate.SHIFT_LEFT,
+                            Gate.SHIFT_RIGHT, Gate.MOD_SWITCH])
+
+# For a list of circuits, the gates of their union are counted once each.
+# Gates already in counted are not counted again, so a set shared between
+# calls does the same across calls.
+def count_gates(circ, gate_types=ALL_GATE_TYPES, counted=None):
+    if counted is None:
+        counted = set()
+    count = 0
+    for node in postorder(circ, counted):
+        counted.add(node)
+        if not node.is_terminal and node.gate_type in gate_types:
+            count += 1
     return count
     
 
+def count_gates_by_type(circ, counted=None):
+    if counted is None:
+        counted = set()
+    counts = {}
+    for node in postorder(circ, counted):
+        counted.add(node)
+        if not node.is_terminal:
+            counts[node.gate_type] = counts.get(node.gate_type, 0) + 1
+    return counts
+    
+
 def print_circuit(circ):
-    if circ.is_terminal:
-        if circ.is_constant:
-            print circ.value,
-        else:
-            print circ.name,
-    else:
-            print '(',
-            print_circuit(circ.left)
-            if circ.gate_type is Gate.MUL:
-                print '*',
-                print_circuit(circ.right)
-            elif circ.gate_type is Gate.ADD:
-                print '+',
-                print_circuit(circ.right)
-            elif circ.gate_type is Gate.SHIFT_LEFT:
-                print ('<< ' + circ.right), 
+    tokens = []
+    stack = [circ]
+    while len(stack) != 0:
+        item = stack.pop()
+        if not isinstance(item, Circuit):
+            tokens.append(item)
+        elif item.is_terminal:
+            if item.is_constant:
+                tokens.append(str(item.value))
             else:
-                print ('>> ' + circ.right), 
-
-            print ')',
-
-
-def compute_depth(circ, depths={}):
-    if circ in depths:
+                tokens.append(str(item.name))
+        elif item.gate_type is Gate.MUL or item.gate_type is Gate.ADD:
+            op = '*' if item.gate_type is Gate.MUL else '+'
+            stack.extend([')', item.right, op, item.left, '('])
+        elif item.gate_type is Gate.SHIFT_LEFT:
+            stack.extend([')', '<< %d' % item.right, item.left, '('])
+        elif item.gate_type is Gate.MOD_SWITCH:
+            stack.extend([')', 'modswitch %d' % item.right, item.left, '('])
+        else:
+            stack.extend([')', '>> %d' % item.right, item.left, '('])
+    print ' '.join(tokens),
+
+
+# The depth of a list of circuits is the greatest of their depths
+def compute_depth(circ, cache=None):
+    depths = _memo(cache, 'compute_depth')
+    for node in postorder(circ, depths):
+        depth = 0
+        if not node.is_terminal:
+            depth = depths[node.left]
+            if not is_unary(node):
+                depth = max(depth, depths[node.right])
+            if node.gate_type is Gate.MUL:
+                depth += 1
+        depths[node] = depth
+    if isinstance(circ, Circuit):
         return depths[circ]
-
-    depth = 0
-    if not circ.is_terminal:
-        left_depth = compute_depth(circ.left, depths)
-        if circ.gate_type is Gate.ADD or circ.gate_type is Gate.MUL:
-            right_depth = compute_depth(circ.right, depths)
+    return max([depths[root] for root in circ] + [0])
+
+# Leveled evaluation. The level of a ciphertext is the number of primes of the
+# modulus chain consumed in computing it: each MUL of two ciphertexts consumes
+# one and each MOD_SWITCH gate the number of levels it switches down by.
+# Subcircuits of constants only are plaintexts, which have no level (None) and
+# can be encoded at any level; multiplying by a plaintext consumes no level.
+# The ciphertext operands of a gate must be at the same level. Operations at a
+# higher level run with fewer primes, so they are cheaper.
+
+# Values that support modulus switching provide a mod_switch method; for other
+# values, such as plaintexts, switching is the identity
+def mod_switch_value(value, num_levels):
+    mod_switch = getattr(value, 'mod_switch', None)
+    if mod_switch is None:
+        return value
+    return mod_switch(num_levels)
+
+def _consumes_level(node, levels):
+    return node.gate_type is Gate.MUL and levels[node.left] is not None and \
+        levels[node.right] is not None
+
+# The level of a list of circuits is the highest of their levels
+def compute_level(circ, cache=None):
+    levels = _memo(cache, 'compute_level')
+    for node in postorder(circ, levels):
+        if node.is_terminal:
+            level = None if node.is_constant else 0
+        elif is_unary(node):
+            level = levels[node.left]
+            if node.gate_type is Gate.MOD_SWITCH and level is not None:
+                level += node.right
+        else:
+            operand_levels = [levels[node.left], levels[node.right]]
+            level = max(l for l in operand_levels + [-1] if l is not None)
+            if level < 0:
+                level = None
+            elif _consumes_level(node, levels):
+                level += 1
+        levels[node] = level
+    if isinstance(circ, Circuit):
+        return levels[circ]
+    root_levels = [levels[root] for root in circ if levels[root] is not None]
+    if len(root_levels) == 0:
+        return None
+    return max(root_levels)
+
+# Assigns every ciphertext reachable from roots (a circuit or a list of
+# circuits) the highest level it can be computed at: the lowest level any of
+# its users needs it at, and the lowest possible level for the roots. Inputs
+# are fresh ciphertexts at level 0. Returns a map from nodes to levels.
+def assign_levels(roots):
+    if isinstance(roots, Circuit):
+        roots = [roots]
+    lowest = {}
+    for root in roots:
+        compute_level(root, lowest)
+
+    needs = dict((root, lowest[root]) for root in roots)
+    levels = {}
+    for node in reversed(list(postorder(roots))):
+        if node.is_terminal or lowest[node] is None:
+            levels[node] = lowest[node]
+            continue
+        level = needs[node]
+        levels[node] = level
+        if _consumes_level(node, lowest):
+            level -= 1
+        elif node.gate_type is Gate.MOD_SWITCH:
+            level -= node.right
+        for child in children(node):
+            if lowest[child] is not None:
+                needs[child] = min(needs.get(child, level), level)
+    return levels
+
+# Places MOD_SWITCH gates so that every gate is computed at the level given by
+# assign_levels, switching each ciphertext down once for every level a user
+# needs it at. Existing MOD_SWITCH gates are replaced. Returns the new circuit
+# (or list of circuits).
+def place_mod_switches(circ):
+    roots = [circ] if isinstance(circ, Circuit) else circ
+    levels = assign_levels(roots)
+    placed = {}
+    switches = {}
+
+    def at_level(node, level):
+        new_node = placed[node]
+        if levels[node] is None or level == levels[node]:
+            return new_node
+        amount = level - levels[node]
+        key = (id(new_node), amount)
+        switch = switches.get(key)
+        if switch is None:
+            switch = _inherit_tag(Gate(Gate.MOD_SWITCH, new_node, amount),
+                                  node)
+            switches[key] = switch
+        return switch
+
+    for node in postorder(roots):
+        if node.is_terminal or levels[node] is None:
+            new_node = node
+        elif node.gate_type is Gate.MOD_SWITCH:
+            new_node = at_level(node.left, levels[node])
+        elif is_unary(node):
+            new_node = Gate(node.gate_type, at_level(node.left, levels[node]),
+                            node.right)
         else:
-            right_depth = 0
-        depth = max(left_depth, right_depth)
-        if circ.gate_type is Gate.MUL:
-            depth += 1
-    depths[circ] = depth
-    return depth
-
-def compare_circuits(circ1, circ2):
-    if not circ1.is_terminal:
-        if circ2.is_terminal:
+            level = levels[node]
+            if _consumes_level(node, levels):
+                level -= 1
+            new_node = Gate(node.gate_type, at_level(node.left, level),
+                            at_level(node.right, level))
+        placed[node] = _inherit_tag(new_node, node)
+
+    if isinstance(circ, Circuit):
+        return placed[circ]
+    return [placed[root] for root in roots]
+
+
+# Structural equality up to commutativity of ADD and MUL. Fingerprints are
+# compared first; a structural confirmation that guards against hash collisions
+# is only done if confirm is set.
+def compare_circuits(circ1, circ2, confirm=False):
+    if circ1 is circ2:
+        return True
+    if circ1.fingerprint != circ2.fingerprint:
+        return False
+    if not confirm:
+        return True
+
+    checked = set()
+    pairs = [(circ1, circ2)]
+    while len(pairs) != 0:
+        c1, c2 = pairs.pop()
+        if c1 is c2 or (id(c1), id(c2)) in checked:
+            continue
+        checked.add((id(c1), id(c2)))
+        if c1.fingerprint != c2.fingerprint or c1.is_terminal != c2.is_terminal:
             return False
-        if circ1.gate_type != circ2.gate_type:
+        if c1.is_terminal:
+            if c1.is_constant != c2.is_constant:
+                return False
+            if c1.is_constant and c1.value != c2.value:
+                return False
+            if not c1.is_constant and c1.name != c2.name:
+                return False
+        elif c1.gate_type != c2.gate_type:
             return False
-        if is_shift(circ1):
-            return compare_circuits(circ1.left, circ2.left) and circ1.right == circ2.right
-        return (compare_circuits(circ1.left, circ2.left) and compare_circuits(circ1.right, circ2.right)) or \
-               (compare_circuits(circ1.left, circ2.right) and compare_circuits(circ1.right, circ2.left))
-    elif not circ2.is_terminal:
-        return False
-    else:
-        if circ1.is_constant and circ2.is_constant:
-            return circ1.value == circ2.value
-        elif not circ1.is_constant and not circ2.is_constant:
-            return circ1.name == circ2.name
-    return False
+        elif is_unary(c1):
+            if c1.right != c2.right:
+                return False
+            pairs.append((c1.left, c2.left))
+        elif c1.left.fingerprint == c2.left.fingerprint:
+            pairs.append((c1.left, c2.left))
+            pairs.append((c1.right, c2.right))
+        else:
+            pairs.append((c1.left, c2.right))
+            pairs.append((c1.right, c2.left))
+    return True
+
+def unique_operands(operands):
+    seen = set()
+    unique = []
+    for operand in operands:
+        if operand.fingerprint not in seen:
+            seen.add(operand.fingerprint)
+            unique.append(operand)
+    return unique
 
 def vect_input(name, dim):
     v = []
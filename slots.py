@@ -0,0 +1,119 @@
+import numpy as np
+
+# Packed plaintext slot vectors for simulating SIMD circuits. The slots are
+# held in a NumPy array and reduced modulo a configurable modulus (2 for GF(2),
+# or a prime p for Z_p). Shifts are rotations, matching the slot rotations of
+# packed FHE ciphertexts: << moves slot i + n to slot i and >> moves slot i to
+# slot i + n. A vector may also hold a batch of several vectors as the rows of
+# a 2-D array, in which case every operation is applied to all of them.
+
+MAX_MODULUS = 1 << 31
+
+class SlotVector(object):
+    def __init__(self, slots, modulus=2):
+        if modulus < 2 or modulus > MAX_MODULUS:
+            raise Exception('Unsupported modulus for slot vector')
+        self._slots = np.mod(np.asarray(slots, dtype=np.int64), modulus)
+        self._modulus = modulus
+
+    @classmethod
+    def _wrap(cls, slots, modulus):
+        vector = cls.__new__(cls)
+        vector._slots = slots
+        vector._modulus = modulus
+        return vector
+
+    @property
+    def slots(self):
+        return self._slots
+
+    @property
+    def modulus(self):
+        return self._modulus
+
+    @property
+    def num_slots(self):
+        return self._slots.shape[-1]
+
+    @property
+    def batch_size(self):
+        if self._slots.ndim == 1:
+            return None
+        return self._slots.shape[0]
+
+    def _check(self, other):
+        if self._modulus != other._modulus:
+            raise Exception('Slot vectors have different moduli')
+        if self.num_slots != other.num_slots:
+            raise Exception('Slot vectors have different numbers of slots')
+
+    def __add__(self, other):
+        self._check(other)
+        slots = self._slots + other._slots
+        slots %= self._modulus
+        return SlotVector._wrap(slots, self._modulus)
+
+    def __mul__(self, other):
+        self._check(other)
+        slots = self._slots * other._slots
+        slots %= self._modulus
+        return SlotVector._wrap(slots, self._modulus)
+
+    def __lshift__(self, num_places):
+        return SlotVector._wrap(np.roll(self._slots, -num_places, axis=-1),
+                                self._modulus)
+
+    def __rshift__(self, num_places):
+        return SlotVector._wrap(np.roll(self._slots, num_places, axis=-1),
+                                self._modulus)
+
+    def __eq__(self, other):
+        return isinstance(other, SlotVector) and \
+            self._modulus == other._modulus and \
+            np.array_equal(self._slots, other._slots)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'SlotVector(%s, modulus=%d)' % (self._slots.tolist(),
+                                               self._modulus)
+
+
+def batch(vectors):
+    modulus = vectors[0].modulus
+    for vector in vectors:
+        if vector.modulus != modulus:
+            raise Exception('Slot vectors have different moduli')
+    return SlotVector._wrap(np.vstack([v.slots for v in vectors]), modulus)
+
+def unbatch(vector):
+    return [SlotVector._wrap(row, vector.modulus) for row in vector.slots]
+
+# A vector holding value in a single slot and zero elsewhere
+def unit(value, nslots, slot=0, modulus=2):
+    slots = np.zeros(nslots, dtype=np.int64)
+    slots[slot] = value
+    return SlotVector(slots, modulus)
+
+# Returns a map_constant function for eval_circuit. A scalar constant fills
+# every slot; a tuple constant gives the slot values directly and is
+# padded with zeros.
+def constant_mapper(nslots, modulus=2):
+    cache = {}
+
+    def map_constant(constant):
+        if constant not in cache:
+            if isinstance(constant, tuple):
+                if len(constant) > nslots:
+                    raise Exception('Constant has more values than slots')
+                slots = np.zeros(nslots, dtype=np.int64)
+                slots[:len(constant)] = constant
+            else:
+                slots = np.full(nslots, constant, dtype=np.int64)
+            cache[constant] = SlotVector(slots, modulus)
+        return cache[constant]
+
+    return map_constant
@@ -1,9 +1,11 @@
 from base import *
+import arith
 import hamming
 import math
 import scdf
 
 # Direct sort from https://eprint.iacr.org/2015/274.pdf
+@scdf.tagged('direct_sort')
 def direct_sort(X):
     N = len(X)
     log_n = int(math.ceil(math.log(N, 2)))
@@ -17,19 +19,21 @@ def direct_sort(X):
 
     s = []
     for i in range(N):
-        s.append(hamming.hamming_weight(M[i])[:-1])
+        s.append(hamming.hamming_weight(M[i])[:log_n])
     
     Y = [0] * N
-    for i in range(N):
-        Y[i] = [zero] * len(X[0])
-        for j in range(N):
-            z = eq(to_constant(i, log_n), s[j])
-            for k in range(len(X[0])):
-                Y[i][k] += z*X[j][k]
+    with scdf.region('select'):
+        for i in range(N):
+            Y[i] = [zero] * len(X[0])
+            for j in range(N):
+                z = eq(to_constant(i, log_n), s[j])
+                for k in range(len(X[0])):
+                    Y[i][k] += z*X[j][k]
 
     return Y
 
 # SIMD-optimized version of direct sort
+@scdf.tagged('direct_sort_p')
 def direct_sort_p(X):
     N = len(X)
     nbits = len(X[0])
@@ -48,44 +52,167 @@ def direct_sort_p(X):
             x.append(fill_slots_with_elem(X[i][j], N))
         M.append(lt(x, a))
 
-    s = hamming_weight(M)[:-1]
+    s = hamming_weight(M, log_n)
 
     zs = []
     ds = []
 
     Y = [0] * N
-    for i in range(N):
-        Y[i] = [zero] * len(X[0])
-        c = to_bin(i, log_n)
-        d = []
-        for j in range(len(c)):
-            if c[j] == 0:
-                d.append(zero)
-            else:
-                d.append(one)
-        z = eq(d, s)
-        zs.append(z)
-        for j in range(N):
-            for k in range(len(X[0])):
-                Y[i][k] += z*X[j][k]
-            z <<= 1
+    with scdf.region('select'):
+        for i in range(N):
+            Y[i] = [zero] * len(X[0])
+            c = to_bin(i, log_n)
+            d = []
+            for j in range(len(c)):
+                if c[j] == 0:
+                    d.append(zero)
+                else:
+                    d.append(one)
+            z = eq(d, s)
+            zs.append(z)
+            for j in range(N):
+                for k in range(len(X[0])):
+                    Y[i][k] += z*X[j][k]
+                z <<= 1
 
     return Y
 
+# Sorts the elements in place with a network of (i, j) compare-exchange pairs
+# that leave the smaller element at i. Since the minimum and the maximum are
+# the two elements in some order, the maximum is their sum plus the minimum,
+# so each exchange takes one multiplication per bit after the comparison.
+@scdf.tagged('sn_sort')
 def sn_sort(sorting_network, elements):
     for (i, j) in sorting_network:
         elem_i = elements[i]
         elem_j = elements[j]
-        is_lt = lt(elem_i, elem_j)
-        min_elem = mux(is_lt, elem_j, elem_i)
-        max_elem = mux(is_lt, elem_i, elem_j)
+        is_lt = arith.lt_tree(elem_j, elem_i)
+        diff = sum_vect(elem_i, elem_j)
+        min_elem = sum_vect(elem_i, [is_lt * d for d in diff])
+        max_elem = sum_vect(diff, min_elem)
         elements[i] = min_elem
         elements[j] = max_elem
+    return elements
+
+# SIMD sorting network. Slot i of the packed vector for bit k holds bit k of
+# element i, and every layer of the network is applied at once: for each
+# distance d between the wires of its comparators, the vector rotated by d is
+# compared slot-wise with the original, the differences at the lower wires
+# are selected with a constant mask and added back at both wires. As with
+# direct_sort_p, each input and output bit holds its value in slot 0.
+@scdf.tagged('sn_sort_p')
+def sn_sort_p(sorting_network, X):
+    N = len(X)
+    nbits = len(X[0])
+    a = []
+    for k in range(nbits):
+        a.append(fill_slots_with_list([X[i][k] for i in range(N)], N))
+
+    for layer in network_layers(sorting_network):
+        by_distance = {}
+        for (i, j) in layer:
+            by_distance.setdefault(j - i, []).append(i)
+        updates = [[] for k in range(nbits)]
+        for d in sorted(by_distance):
+            mask = [0] * N
+            for i in by_distance[d]:
+                mask[i] = 1
+            mask = scdf.Constant(tuple(mask))
+            b = [x << d for x in a]
+            is_lt = arith.lt_tree(b, a)
+            for k in range(nbits):
+                t = is_lt * ((a[k] + b[k]) * mask)
+                updates[k].extend([t, t >> d])
+        for k in range(nbits):
+            a[k] = sum(updates[k], a[k])
+
+    e0 = scdf.Constant((1,))
+    Y = []
+    for i in range(N):
+        Y.append([(x << i) * e0 for x in a])
+    return Y
+
+
+# Sorting network generators. A network is a list of (i, j) pairs with i < j,
+# and comparators are listed in an order in which they can be applied.
+
+# Batcher's odd-even merge sort for any n, in the merge exchange form given
+# by Knuth (The Art of Computer Programming, Algorithm 5.2.2M)
+def odd_even_merge_network(n):
+    network = []
+    if n < 2:
+        return network
+    t = int(math.ceil(math.log(n, 2)))
+    p = 1 << (t - 1)
+    while p > 0:
+        q = 1 << (t - 1)
+        r = 0
+        d = p
+        while True:
+            for i in range(n - d):
+                if i & p == r:
+                    network.append((i, i + d))
+            if q == p:
+                break
+            d = q - p
+            q >>= 1
+            r = p
+        p >>= 1
+    return network
+
+# Bitonic sort in the variant whose comparators all put the minimum on the
+# lower wire. For n not a power of 2 the network for the next power of 2 is
+# pruned: the missing elements act as maxima on the top wires, which such
+# comparators never move.
+def bitonic_network(n):
+    network = []
+    size = 1
+    while size < n:
+        size *= 2
+    k = 2
+    while k <= size:
+        for start in range(0, size, k):
+            for i in range(k // 2):
+                network.append((start + i, start + k - 1 - i))
+        j = k // 4
+        while j > 0:
+            for i in range(size):
+                if i & j == 0:
+                    network.append((i, i | j))
+            j //= 2
+        k *= 2
+    return [(i, j) for (i, j) in network if j < n]
+
+# Groups the comparators of a network into layers of comparators on disjoint
+# wires, placing each comparator in the earliest layer after the last one
+# using either of its wires
+def network_layers(sorting_network):
+    layers = []
+    wire_layers = {}
+    for (i, j) in sorting_network:
+        layer = max(wire_layers.get(i, 0), wire_layers.get(j, 0))
+        if layer == len(layers):
+            layers.append([])
+        layers[layer].append((i, j))
+        wire_layers[i] = wire_layers[j] = layer + 1
+    return layers
+
+# Slot-wise hamming weight of v, returning the nbits least significant bits
+# (by default enough bits for any weight). Bit i has multiplicative depth i.
+# For 4 and 8 elements and at most log2(len(v)) bits, the hand-optimized
+# circuits below use fewer multiplications; otherwise the general algorithm in
+# hamming.py is used.
+@scdf.tagged('hamming_weight')
+def hamming_weight(v, nbits=None):
+    if nbits is None:
+        nbits = int(math.floor(math.log(len(v), 2))) + 1
+    if len(v) in [4, 8] and 2**nbits <= len(v):
+        return hamming_weight_cdss(v)[:nbits]
+    return hamming.hamming_weight_direct(v)[:nbits]
 
 # This algorithm is due to Cetin, Doroz, Sunar and Savas
-# Currently, we only have support for length 4 and length 8
-# vectors
-def hamming_weight(v):
+# It computes the hamming weight modulo len(v) for vectors of length 4 and 8
+def hamming_weight_cdss(v):
     if len(v) == 4:
         result = [0] * 2
         s = v[0] + v[1] + v[2]
@@ -114,61 +241,6 @@ def hamming_weight(v):
         c22 = s21*c11
         s33 = c21 + c22
         result[2] = s33
-    elif len(v) == 16:
-        result = [zero] * 4
-		
-        s1 = v[0] + v[1] + v[2]
-        s2 = v[3] + v[4] + v[5]
-        s3 = v[6] + v[7] + v[8]
-        s4 = v[9] + v[10] + v[11]
-        s5 = v[12] + v[13] + v[14]
-        s6 = v[15]
-		
-        s11 = s1 + s2 + s3
-        s12 = s4 + s5 + s6
-	result[0] = s11 + s12
-		
-	c1 = v[0]*v[1] + v[0]*v[2] + v[1]*v[2]
-        c2 = v[3]*v[4] + v[3]*v[5] + v[4]*v[5]
-        c3 = v[6]*v[7] + v[6]*v[8] + v[7]*v[8]
-	c4 = v[9]*v[10] + v[9]*v[11] + v[10]*v[11]
-	c5 = v[12]*v[13] + v[12]*v[14] + v[13]*v[14]
-	c6 = v[15]
-		
-	c21 = c1 + c2 + c3
-	c22 = c4 + c5
-	s21 = s1*s2 + s1*s3 + s2*s3
-	s22 = s4*s5 + s4*s6 + s5*s6
-	s23 = s1*s4 + s1*s5 + s1*s6
-	s24 = s2*s4 + s2*s5 + s2*s6
-	s25 = s3*s4 + s3*s5 + s3*s6
-	result[1] = c21 + c22 + s21 + s22 + s23 + s24 + s25
-
-
-	c31 = c1*c2 + c1*c3 + c2*c3
-	c32 = c1*c4 + c1*c5 + c4*c5
-	c33 = c2*c4 + c2*c5
-	c34 = c3*c4 + c3*c5
-
-        s31 = s21*s22 + s21*s23 + s22*s23
-        s32 = s21*s24 + s21*s25 + s24*s25
-        s33 = s22*s24 + s22*s25
-        s34 = s23*s24 + s23*s25
-
-        result[2] = (c21 + c22)*(s21 + s22 + s23 + s24 + s24) + c31 + c32 + c33 + c34 + s31 + s32 + s33 + s34
-
-        s35 = (c21 + c22)*(s21 + s22 + s23 + s24 + s24)
-
-        c41 = c31*c32 + c31*c33 + c32*c33
-        c42 = c31*c34 + c32*c34 + c33*c34
-
-        s41 = s31*s32 + s31*s33 + s32*s33
-        s42 = s31*s34 + s32*s34 + s34*s35
-        s43 = s33*s34 + s33*s35 + s32*s35
-
-        result[3] = (c31 + c32 + c33 + c34)*(s31 + s32 + s33 + s34 + s35) + c41 + c42 + s41 + s42 \
-                    + s43
-	
     else:
         raise Exception('Unsupported length in hamming weight algorithm')
         
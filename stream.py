@@ -0,0 +1,403 @@
+import array
+import json
+import mmap
+import os
+import struct
+
+import scdf
+
+# Streaming circuit construction for circuits too large to hold in memory. A
+# Builder appends every node to an on-disk, append-only node log as it is
+# created and hands out Handle objects, which support the same operators as
+# circuits and hold the index of their record in the log rather than their
+# operands. Builder functions such as sort.direct_sort and those of arith work
+# unchanged on handles, and the nodes are written in creation order, which is a
+# topological order. The log is a sequence of fixed-size records (opcode, lhs,
+# rhs) in the layout of a tape instruction: for gates, the opcode is the gate
+# type, lhs the index of the left operand and rhs the index of the right
+# operand or the number of places or levels; inputs and constants have their
+# own opcodes and lhs indexes the table of input names or of constant values.
+# The tables and the indexes of the outputs are written to a metadata file next
+# to the log when the builder is closed. The passes below read the log through
+# mmap and keep at most a few bytes per node in flat arrays, besides the values
+# live during evaluation, so peak memory no longer grows with Python objects
+# for every gate.
+
+INPUT = 0
+CONSTANT = -1
+
+_record = struct.Struct('<bqq')
+
+def _metadata_path(path):
+    return path + '.meta'
+
+
+# Besides its index, a handle carries the multiplicative depth and the
+# structural fingerprint of the node it stands for, computed as for circuits.
+# These are what arith needs to order bits by depth and build balanced product
+# trees on nodes that are not circuits. Handles are not circuits, and the
+# passes of scdf reject them.
+class Handle(object):
+    __slots__ = ('_builder', '_index', '_depth', '_fingerprint', '__weakref__')
+
+    def __init__(self, builder, index, depth, fingerprint):
+        self._builder = builder
+        self._index = index
+        self._depth = depth
+        self._fingerprint = fingerprint
+
+    @property
+    def builder(self):
+        return self._builder
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def depth(self):
+        return self._depth
+
+    @property
+    def fingerprint(self):
+        return self._fingerprint
+
+    # Handles are opaque to the folding in scdf.fold_gate, which only folds
+    # terminals
+    @property
+    def is_terminal(self):
+        return False
+
+    def __add__(self, other):
+        return self._builder.gate(scdf.Gate.ADD, self, other)
+
+    def __radd__(self, other):
+        return self._builder.gate(scdf.Gate.ADD, other, self)
+
+    def __mul__(self, other):
+        return self._builder.gate(scdf.Gate.MUL, self, other)
+
+    def __rmul__(self, other):
+        return self._builder.gate(scdf.Gate.MUL, other, self)
+
+    def __lshift__(self, num_places):
+        return self._builder.gate(scdf.Gate.SHIFT_LEFT, self, num_places)
+
+    def __rshift__(self, num_places):
+        return self._builder.gate(scdf.Gate.SHIFT_RIGHT, self, num_places)
+
+    def mod_switch(self, num_levels):
+        return self._builder.gate(scdf.Gate.MOD_SWITCH, self, num_levels)
+
+    def __repr__(self):
+        return 'Handle(%d)' % self._index
+
+
+class Builder(object):
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, 'wb')
+        self._count = 0
+        self._names = []
+        self._inputs = {}
+        self._constants = []
+        self._constant_indexes = {}
+        # Circuits used as operands (constants such as base.zero and gates on
+        # them) are written to the log once each
+        self._emitted = {}
+
+    @property
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        return self._count
+
+    def _append(self, op, lhs, rhs):
+        self._file.write(_record.pack(op, lhs, rhs))
+        self._count += 1
+        return self._count - 1
+
+    # Inputs and constants are written once per name or value
+    def input(self, name):
+        index = self._inputs.get(name)
+        if index is None:
+            index = self._append(INPUT, len(self._names), 0)
+            self._names.append(name)
+            self._inputs[name] = index
+        return Handle(self, index, 0, hash(('input', name)))
+
+    def constant(self, value):
+        index = self._constant_indexes.get(value)
+        if index is None:
+            index = self._append(CONSTANT, len(self._constants), 0)
+            self._constants.append(value)
+            self._constant_indexes[value] = index
+        return Handle(self, index, 0, hash(('constant', value)))
+
+    def vect_input(self, name, dim):
+        return [self.input('%s%d' % (name, i)) for i in range(dim)]
+
+    def array_input(self, name, n, nbits):
+        return [self.vect_input('%s%d' % (name, i), nbits) for i in range(n)]
+
+    def _emit(self, circ):
+        for node in scdf.postorder(circ, self._emitted):
+            if node.is_terminal:
+                if node.is_constant:
+                    index = self.constant(node.value).index
+                else:
+                    index = self.input(node.name).index
+            elif scdf.is_unary(node):
+                index = self._append(node.gate_type, self._emitted[node.left],
+                                     node.right)
+            else:
+                index = self._append(node.gate_type, self._emitted[node.left],
+                                     self._emitted[node.right])
+            self._emitted[node] = index
+        return self._emitted[circ]
+
+    def _circuit_handle(self, circ):
+        return Handle(self, self._emit(circ), scdf.compute_depth(circ),
+                      circ.fingerprint)
+
+    # Handle of an operand, which is a handle of this builder, a circuit or a
+    # constant value
+    def _operand(self, operand):
+        if isinstance(operand, Handle):
+            if operand.builder is not self:
+                raise Exception('Handle belongs to another builder')
+            return operand
+        if isinstance(operand, scdf.Circuit):
+            return self._circuit_handle(operand)
+        return self.constant(operand)
+
+    def gate(self, gate_type, left, right):
+        if self._file is None:
+            raise Exception('Builder is closed')
+        left = self._operand(left)
+        if scdf.is_unary_type(gate_type):
+            return Handle(self, self._append(gate_type, left.index, right),
+                          left.depth,
+                          hash((gate_type, left.fingerprint, right)))
+
+        right = self._operand(right)
+        depth = max(left.depth, right.depth)
+        if gate_type == scdf.Gate.MUL:
+            depth += 1
+        fingerprints = sorted([left.fingerprint, right.fingerprint])
+        return Handle(self, self._append(gate_type, left.index, right.index),
+                      depth, hash((gate_type,) + tuple(fingerprints)))
+
+    # Returns handles for the outputs of existing circuits
+    def emit(self, outputs):
+        if isinstance(outputs, scdf.Circuit):
+            return self._circuit_handle(outputs)
+        return [self._circuit_handle(output) for output in outputs]
+
+    # Finishes the log with the outputs (a handle or a list of handles, which
+    # may also be circuits such as constant bits) and returns it opened for
+    # reading
+    def close(self, outputs):
+        if self._file is None:
+            raise Exception('Builder is closed')
+        if isinstance(outputs, (Handle, scdf.Circuit)):
+            outputs = [outputs]
+        indexes = [self._operand(output).index for output in outputs]
+        self._file.close()
+        self._file = None
+        self._emitted = {}
+        metadata = {'records': self._count, 'input_names': self._names,
+                    'constants': self._constants, 'outputs': indexes}
+        with open(_metadata_path(self._path), 'w') as f:
+            json.dump(metadata, f)
+        return NodeLog(self._path)
+
+
+# Writes existing circuits to a node log
+def write(outputs, path):
+    builder = Builder(path)
+    return builder.close(builder.emit(outputs))
+
+
+def _constant_value(value):
+    # tuple constants come back from JSON as lists
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+class NodeLog(object):
+    def __init__(self, path):
+        with open(_metadata_path(path)) as f:
+            metadata = json.load(f)
+        self._path = path
+        self._count = metadata['records']
+        self._input_names = [str(name) for name in metadata['input_names']]
+        self._constants = [_constant_value(value)
+                           for value in metadata['constants']]
+        self._outputs = metadata['outputs']
+        self._file = open(path, 'rb')
+        if os.fstat(self._file.fileno()).st_size != \
+           self._count * _record.size:
+            raise Exception('Node log does not match its metadata')
+        self._map = None
+        if self._count != 0:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def input_names(self):
+        return self._input_names
+
+    @property
+    def constants(self):
+        return self._constants
+
+    @property
+    def outputs(self):
+        return self._outputs
+
+    def __len__(self):
+        return self._count
+
+    def record(self, index):
+        return _record.unpack_from(self._map, index * _record.size)
+
+    # Records in log order, or in reverse
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield _record.unpack_from(self._map, index * _record.size)
+
+    def __reversed__(self):
+        for index in xrange(self._count - 1, -1, -1):
+            yield _record.unpack_from(self._map, index * _record.size)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+def _is_gate(op):
+    return op != INPUT and op != CONSTANT
+
+# One byte per record, set for the records the outputs depend on. A builder
+# also logs the gates that end up unused, which the passes skip.
+def reachable(log):
+    marks = bytearray(len(log))
+    for index in log.outputs:
+        marks[index] = 1
+    index = len(log)
+    for op, lhs, rhs in reversed(log):
+        index -= 1
+        if not marks[index] or not _is_gate(op):
+            continue
+        marks[lhs] = 1
+        if not scdf.is_unary_type(op):
+            marks[rhs] = 1
+    return marks
+
+def count_gates_by_type(log, marks=None):
+    if marks is None:
+        marks = reachable(log)
+    counts = {}
+    for index, (op, lhs, rhs) in enumerate(log):
+        if marks[index] and _is_gate(op):
+            counts[op] = counts.get(op, 0) + 1
+    return counts
+
+def count_gates(log, gate_types=scdf.ALL_GATE_TYPES, marks=None):
+    counts = count_gates_by_type(log, marks)
+    return sum(count for op, count in counts.iteritems() if op in gate_types)
+
+# The multiplicative depth of the outputs, as scdf.compute_depth
+def compute_depth(log):
+    depths = array.array('l', [0]) * len(log)
+    for index, (op, lhs, rhs) in enumerate(log):
+        if not _is_gate(op):
+            continue
+        depth = depths[lhs]
+        if not scdf.is_unary_type(op):
+            depth = max(depth, depths[rhs])
+        if op == scdf.Gate.MUL:
+            depth += 1
+        depths[index] = depth
+    return max([depths[index] for index in log.outputs] + [0])
+
+# For each reachable record, the index of the last record using it, with the
+# outputs used past the end of the log. Unreachable records get -1.
+def last_uses(log, marks=None):
+    if marks is None:
+        marks = reachable(log)
+    uses = array.array('l', [-1]) * len(log)
+    for index, (op, lhs, rhs) in enumerate(log):
+        if not marks[index] or not _is_gate(op):
+            continue
+        uses[lhs] = index
+        if not scdf.is_unary_type(op):
+            uses[rhs] = index
+    for index in log.outputs:
+        uses[index] = len(log)
+    return uses
+
+# Evaluates the outputs in one sequential pass over the log, as eval_circuit.
+# Each value is dropped after its last use, so only the values live at a
+# point of the log are held at once.
+def evaluate(log, input_map, map_constant):
+    uses = last_uses(log)
+    values = {}
+    for index, (op, lhs, rhs) in enumerate(log):
+        if uses[index] < 0:
+            continue
+        if op == INPUT:
+            name = log.input_names[lhs]
+            if name not in input_map:
+                raise Exception('Input not found in input map')
+            value = input_map[name]
+        elif op == CONSTANT:
+            value = map_constant(log.constants[lhs])
+        elif op == scdf.Gate.ADD:
+            value = values[lhs] + values[rhs]
+        elif op == scdf.Gate.MUL:
+            value = values[lhs] * values[rhs]
+        elif op == scdf.Gate.SHIFT_LEFT:
+            value = values[lhs] << rhs
+        elif op == scdf.Gate.SHIFT_RIGHT:
+            value = values[lhs] >> rhs
+        elif op == scdf.Gate.MOD_SWITCH:
+            value = scdf.mod_switch_value(values[lhs], rhs)
+        else:
+            raise Exception('Unknown gate type')
+        values[index] = value
+
+        if _is_gate(op):
+            if uses[lhs] == index:
+                del values[lhs]
+            if not scdf.is_unary_type(op) and rhs != lhs and \
+               uses[rhs] == index:
+                del values[rhs]
+    return [values[index] for index in log.outputs]
+
+# Loads the reachable part of the log as circuits, for running the in-memory
+# passes on logs that fit in memory
+def to_circuits(log):
+    uses = last_uses(log)
+    nodes = {}
+    for index, (op, lhs, rhs) in enumerate(log):
+        if uses[index] < 0:
+            continue
+        if op == INPUT:
+            node = scdf.Input(log.input_names[lhs])
+        elif op == CONSTANT:
+            node = scdf.Constant(log.constants[lhs])
+        elif scdf.is_unary_type(op):
+            node = scdf.Gate(op, nodes[lhs], rhs)
+        else:
+            node = scdf.Gate(op, nodes[lhs], nodes[rhs])
+        nodes[index] = node
+    return [nodes[index] for index in log.outputs]
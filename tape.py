@@ -0,0 +1,138 @@
+import array
+from itertools import izip
+
+import scdf
+
+# A circuit lowered to a flat, topologically ordered instruction tape. Slots
+# 0 .. ninputs-1 hold the inputs, followed by one slot per distinct constant
+# and one slot per instruction. Each instruction is stored across three arrays:
+# its opcode (the gate type), the slot of its left operand and either the slot
+# of its right operand or, for shifts and modulus switches, the number of
+# places or levels.
+class Tape(object):
+    def __init__(self, input_names, constants, opcodes, lhs, rhs, outputs):
+        self._input_names = input_names
+        self._constants = constants
+        self._opcodes = opcodes
+        self._lhs = lhs
+        self._rhs = rhs
+        self._outputs = outputs
+
+    @property
+    def input_names(self):
+        return self._input_names
+
+    @property
+    def constants(self):
+        return self._constants
+
+    @property
+    def opcodes(self):
+        return self._opcodes
+
+    @property
+    def lhs(self):
+        return self._lhs
+
+    @property
+    def rhs(self):
+        return self._rhs
+
+    @property
+    def outputs(self):
+        return self._outputs
+
+    @property
+    def num_slots(self):
+        return len(self._input_names) + len(self._constants) + \
+            len(self._opcodes)
+
+    def __len__(self):
+        return len(self._opcodes)
+
+    def input_vector(self, input_map):
+        inputs = []
+        for name in self._input_names:
+            if name not in input_map:
+                raise Exception('Input not found in input map')
+            inputs.append(input_map[name])
+        return inputs
+
+    def run(self, inputs, map_constant):
+        if len(inputs) != len(self._input_names):
+            raise Exception('Number of inputs does not match the tape')
+        slots = list(inputs)
+        slots.extend(map(map_constant, self._constants))
+        slots.extend([None] * len(self._opcodes))
+
+        ADD = scdf.Gate.ADD
+        MUL = scdf.Gate.MUL
+        SHIFT_LEFT = scdf.Gate.SHIFT_LEFT
+        SHIFT_RIGHT = scdf.Gate.SHIFT_RIGHT
+        dest = len(self._input_names) + len(self._constants)
+        for op, a, b in izip(self._opcodes, self._lhs, self._rhs):
+            if op == ADD:
+                slots[dest] = slots[a] + slots[b]
+            elif op == MUL:
+                slots[dest] = slots[a] * slots[b]
+            elif op == SHIFT_LEFT:
+                slots[dest] = slots[a] << b
+            elif op == SHIFT_RIGHT:
+                slots[dest] = slots[a] >> b
+            else:
+                slots[dest] = scdf.mod_switch_value(slots[a], b)
+            dest += 1
+
+        return [slots[i] for i in self._outputs]
+
+    def evaluate(self, input_map, map_constant):
+        return self.run(self.input_vector(input_map), map_constant)
+
+
+def compile(outputs):
+    if isinstance(outputs, scdf.Circuit):
+        outputs = [outputs]
+
+    input_slots = {}
+    constant_slots = {}
+    gates = []
+    for node in scdf.postorder(outputs):
+        if not node.is_terminal:
+            gates.append(node)
+        elif node.is_constant:
+            constant_slots.setdefault(node.value, len(constant_slots))
+        else:
+            input_slots.setdefault(node.name, len(input_slots))
+
+    input_names = [None] * len(input_slots)
+    for name, i in input_slots.iteritems():
+        input_names[i] = name
+    constants = [None] * len(constant_slots)
+    for value, i in constant_slots.iteritems():
+        constants[i] = value
+
+    ninputs = len(input_names)
+    base = ninputs + len(constants)
+
+    def slot(node):
+        if node.is_terminal:
+            if node.is_constant:
+                return ninputs + constant_slots[node.value]
+            return input_slots[node.name]
+        return gate_slots[node]
+
+    gate_slots = {}
+    opcodes = array.array('b')
+    lhs = array.array('l')
+    rhs = array.array('l')
+    for i, gate in enumerate(gates):
+        gate_slots[gate] = base + i
+        opcodes.append(gate.gate_type)
+        lhs.append(slot(gate.left))
+        if scdf.is_unary(gate):
+            rhs.append(gate.right)
+        else:
+            rhs.append(slot(gate.right))
+
+    return Tape(input_names, constants, opcodes, lhs, rhs,
+                [slot(output) for output in outputs])
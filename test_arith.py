@@ -0,0 +1,65 @@
+import random
+import arith
+import base
+import bitslice
+import scdf
+
+# number of assignments evaluated at once
+width = 4096
+
+# Evaluates f on random nbits-bit operands a and b and compares the numbers
+# given by its output bits against expected
+def check(f, nbits, expected, rng):
+    a = scdf.vect_input('a', nbits)
+    b = scdf.vect_input('b', nbits)
+    outputs = f(a, b)
+    if isinstance(outputs, scdf.Circuit):
+        outputs = [outputs]
+    input_map = bitslice.random_inputs(
+        ['a%d' % i for i in range(nbits)] + ['b%d' % i for i in range(nbits)],
+        width, rng)
+    xs = bitslice.unpack_numbers([input_map['a%d' % i] for i in range(nbits)],
+                                 width)
+    ys = bitslice.unpack_numbers([input_map['b%d' % i] for i in range(nbits)],
+                                 width)
+    results = bitslice.unpack_numbers(
+        bitslice.eval_batch(outputs, input_map, width), width)
+    for j in range(width):
+        assert results[j] == expected(xs[j], ys[j])
+
+def test_primitives():
+    rng = random.Random(3)
+    for nbits in [1, 2, 3, 5, 8, 13]:
+        for adder in arith.ADDERS:
+            check(adder, nbits, lambda x, y: x + y, rng)
+            check(lambda a, b: adder(a, b, base.one), nbits,
+                  lambda x, y: x + y + 1, rng)
+            check(lambda a, b: arith.sub(a, b, adder), nbits,
+                  lambda x, y: (x - y) % (1 << nbits), rng)
+        for multiplier in arith.MULTIPLIERS:
+            check(multiplier, nbits, lambda x, y: x * y, rng)
+        check(lambda a, b: arith.carry_save_add([a, b, a, b, b]), nbits,
+              lambda x, y: 2*x + 3*y, rng)
+        check(arith.lt_tree, nbits, lambda x, y: int(x < y), rng)
+        check(arith.eq_tree, nbits, lambda x, y: int(x == y), rng)
+    print 'Arithmetic primitives checked on', width, 'assignments'
+
+def test_costs():
+    nbits = 16
+    for primitives in [arith.ADDERS, arith.MULTIPLIERS, arith.COMPARATORS]:
+        for primitive in primitives:
+            print primitive.__name__, arith.cost(primitive, nbits)
+    assert arith.cheapest(arith.ADDERS, nbits) is arith.kogge_stone_add
+    assert arith.cheapest(arith.COMPARATORS, nbits) is arith.lt_tree
+    assert arith.cost(arith.lt_tree, nbits)['depth'] < \
+        arith.cost(base.lt, nbits)['depth']
+    for noperands in [3, 8]:
+        csa = arith.cost(arith.carry_save_add, nbits, noperands)
+        print 'carry_save_add of', noperands, 'operands', csa
+        # shallower than a balanced tree of prefix adders
+        levels = (noperands - 1).bit_length()
+        assert csa['depth'] < \
+            levels * arith.cost(arith.kogge_stone_add, nbits)['depth']
+
+test_primitives()
+test_costs()
@@ -0,0 +1,82 @@
+import random
+import bitslice
+import hamming
+import scdf
+import sort
+
+# number of assignments evaluated at once
+width = 4096
+
+def test_hamming_weight():
+    num_bits = 24
+    v = scdf.vect_input('v', num_bits)
+    w = hamming.hamming_weight(v)
+
+    rng = random.Random(1)
+    names = ['v%d' % i for i in range(num_bits)]
+    input_map = bitslice.random_inputs(names, width, rng)
+    weights = bitslice.unpack_numbers(bitslice.eval_batch(w, input_map, width),
+                                      width)
+    expected = bitslice.unpack_numbers([input_map[name] for name in names],
+                                       width)
+    expected = [bin(n).count('1') for n in expected]
+    assert weights == expected
+    print 'Hamming weight checked on', width, 'vectors'
+
+def test_direct_sort():
+    N = 4
+    nbits = 3
+    X = scdf.array_input('X', N, nbits)
+    Y = sort.direct_sort(X)
+
+    rng = random.Random(2)
+    input_map = bitslice.random_inputs(
+        ['X%d%d' % (i, k) for i in range(N) for k in range(nbits)], width, rng)
+    outputs = bitslice.eval_batch([b for y in Y for b in y], input_map, width)
+
+    elements = []
+    for i in range(N):
+        elements.append(bitslice.unpack_numbers(
+            [input_map['X%d%d' % (i, k)] for k in range(nbits)], width))
+    results = []
+    for i in range(N):
+        results.append(bitslice.unpack_numbers(
+            outputs[i*nbits:(i + 1)*nbits], width))
+
+    checked = 0
+    for j in range(width):
+        array = [elements[i][j] for i in range(N)]
+        # direct sort requires distinct elements
+        if len(set(array)) != N:
+            continue
+        assert [results[i][j] for i in range(N)] == sorted(array)
+        checked += 1
+    print 'Direct sort checked on', checked, 'arrays'
+
+def test_sn_sort():
+    N = 6
+    nbits = 3
+    names = ['X%d%d' % (i, k) for i in range(N) for k in range(nbits)]
+    rng = random.Random(4)
+    input_map = bitslice.random_inputs(names, width, rng)
+    elements = []
+    for i in range(N):
+        elements.append(bitslice.unpack_numbers(
+            [input_map['X%d%d' % (i, k)] for k in range(nbits)], width))
+    arrays = [sorted(elements[i][j] for i in range(N)) for j in range(width)]
+
+    for network in [sort.odd_even_merge_network(N), sort.bitonic_network(N)]:
+        Y = sort.sn_sort(network, scdf.array_input('X', N, nbits))
+        outputs = bitslice.eval_batch([b for y in Y for b in y], input_map,
+                                      width)
+        results = []
+        for i in range(N):
+            results.append(bitslice.unpack_numbers(
+                outputs[i*nbits:(i + 1)*nbits], width))
+        for j in range(width):
+            assert [results[i][j] for i in range(N)] == arrays[j]
+    print 'Sorting networks checked on', width, 'arrays'
+
+test_hamming_weight()
+test_direct_sort()
+test_sn_sort()
@@ -43,14 +43,17 @@ def test_hamming_weight():
         weight_bits.append(bit.val)
     weight = utils.from_bin(weight_bits)
     print 'Hamming weight: ', weight
+
+    mul_counts = [scdf.count_gates(circs, set([scdf.Gate.MUL]))
+                  for circs in [w, scdf.normalize_gf2(w)]]
+    print 'MULs removed by GF(2) normalization: ', mul_counts[0] - mul_counts[1]
         
-    reduced = map(scdf.reduce_depth, w)
+    reduced = scdf.reduce_depth(w)
     depths = map(scdf.compute_depth, reduced)
     print 'Depths of each output bit: ', depths
 
-    deduplicated = map(scdf.deduplicate, reduced)
+    deduplicated = scdf.deduplicate(reduced)
     print 'Number of gates: ',
-    counts = map(scdf.count_gates, deduplicated)
-    print sum(counts)
+    print scdf.count_gates(deduplicated)
 
 test_hamming_weight()
@@ -0,0 +1,32 @@
+import random
+import incremental
+import testutils
+
+# After each change of a few inputs, the incrementally updated outputs must
+# equal those of a fresh evaluation
+def check(case, rng):
+    evaluator = incremental.IncrementalEvaluator(case.outputs,
+                                                 case.map_constant)
+    input_map = case.random_inputs(rng)
+    evaluator.evaluate(input_map)
+    names = sorted(input_map)
+    recomputed = 0
+    for k in range(20):
+        changes = dict((name, case.random_value(rng))
+                       for name in rng.sample(names, rng.randint(1, 3)))
+        input_map.update(changes)
+        values = evaluator.update(changes)
+        assert case.unpack(values) == case.expected(input_map)
+        assert evaluator.recomputed <= len(evaluator.tape)
+        recomputed += evaluator.recomputed
+    total = 20 * len(evaluator.tape)
+    assert recomputed < total
+    print case.name, 'updated recomputing', recomputed, 'of', total, 'gates'
+
+def test_incremental():
+    rng = random.Random(11)
+    for case in [testutils.direct_sort_case(),
+                 testutils.direct_sort_p_case()]:
+        check(case, rng)
+
+test_incremental()
@@ -0,0 +1,41 @@
+import noise
+import scdf
+
+def close(x, y):
+    return abs(x - y) < 1e-12
+
+# A small circuit worked out by hand with the default noise model:
+#   c = a*b       mul at level 0: level 1, consumed 10 + 30 = 40
+#   d = c + a     a switched down from level 0, add at level 1: consumed 41
+#   e = d*3       plain_mul at level 1: consumed 51
+#   f = e << 1    rotate at level 1: consumed 53
+# The chain needs 53 + 1 + 10 = 64 bits: a 30-bit prime for the level and a
+# 34-bit base prime.
+def test_simulate():
+    a, b = scdf.Input('a'), scdf.Input('b')
+    e = (a * b + a) * scdf.Constant(3)
+    f = e << 1
+
+    report = noise.simulate(f)
+    assert report['levels'] == 1
+    assert report['consumed'] == 53
+    assert report['modulus_chain'] == [34, 30]
+    assert report['log_q'] == 64
+    assert report['operations'] == {'mul': 1, 'relinearize': 1,
+                                    'mod_switch': 1, 'add': 1,
+                                    'plain_mul': 1, 'rotate': 1}
+    # operations at level 0 run with both primes, at level 1 with one
+    costs = noise.NoiseModel().costs
+    expected = 2 * (costs['mul'] + costs['relinearize'] +
+                    costs['mod_switch']) + \
+        costs['add'] + costs['plain_mul'] + costs['rotate']
+    assert close(report['wall_clock'], expected)
+    assert report['exhausted'] == 0
+
+    # with 45 bits, e has 45 - 1 - 51 < 0 bits left while d has 3
+    report = noise.simulate(f, modulus_bits=45)
+    assert report['exhausted'] == 2
+    assert report['exhausted_nodes'] == [e]
+    print 'Simulated costs and noise checked'
+
+test_simulate()
@@ -0,0 +1,30 @@
+import random
+from multiprocessing.pool import ThreadPool
+import parallel
+import testutils
+
+# Evaluation with a thread pool, with one or several gates per task, must
+# give the outputs of serial evaluation
+def check(case, rng, pool):
+    for i in range(5):
+        input_map = case.random_inputs(rng)
+        expected = case.expected(input_map)
+        for chunk_size in [1, 7]:
+            values = parallel.eval_parallel(case.outputs, input_map,
+                                            case.map_constant, pool,
+                                            chunk_size=chunk_size)
+            assert case.unpack(values) == expected
+    print case.name, 'evaluated in parallel'
+
+def test_parallel(pool):
+    rng = random.Random(8)
+    for case in [testutils.hamming_weight_case(),
+                 testutils.direct_sort_p_case()]:
+        check(case, rng, pool)
+
+pool = ThreadPool(4)
+try:
+    test_parallel(pool)
+finally:
+    pool.close()
+    pool.join()
@@ -0,0 +1,31 @@
+import gc
+import weakref
+import profiler
+import scdf
+import testutils
+
+# The profile has one call per gate, and does not keep the circuit alive
+def test_profiler():
+    case = testutils.hamming_weight_case(16)
+    w = case.outputs
+    input_map = dict((name, testutils.Bit(i % 3))
+                     for i, name in enumerate(case.input_names))
+    prof = profiler.Profiler()
+    scdf.eval_circuit(w, input_map, case.map_constant, prof)
+
+    counts = scdf.count_gates_by_type(w)
+    profile = prof.flat_profile()
+    assert dict((name, summary['calls']) for name, summary
+                in profile['gate_types'].iteritems()) == \
+        dict((scdf.GATE_NAMES[t], count) for t, count in counts.iteritems())
+    assert sum(summary['calls'] for summary in profile['levels']) == \
+        sum(counts.values())
+    assert 'hamming_weight_direct' in profile['regions']
+
+    ref = weakref.ref(w[-1])
+    del w, case
+    gc.collect()
+    assert ref() is None
+    print 'Profiled', len(prof.records), 'gates'
+
+test_profiler()
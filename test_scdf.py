@@ -0,0 +1,372 @@
+import copy
+import gc
+import pickle
+import random
+import weakref
+import base
+import hamming
+import scdf
+import slots
+import sort
+import testutils
+import utils
+
+# Passes sharing a cache keep their results apart
+def test_shared_cache():
+    a, b, c, d = scdf.vect_input('x', 4)
+    circ = (a * b) * (c * d) + a * (b * (c * d))
+    cache = scdf.Cache()
+    reduced = scdf.reduce_depth(circ, cache)
+    assert scdf.compute_depth(circ, cache) == 3
+    assert scdf.compute_depth(reduced, cache) == 2
+    assert scdf.reduce_depth(circ, cache) is reduced
+    assert cache.hits > 0
+    for bits in [(1, 1, 1, 1), (1, 0, 1, 1)]:
+        input_map = dict(('x%d' % i, testutils.Bit(bit))
+                         for i, bit in enumerate(bits))
+        assert testutils.bit_values(scdf.eval_circuit(
+            [circ, a * b], input_map, testutils.map_constant)) == \
+            [0, bits[0] * bits[1]]
+    print 'Shared cache checked'
+
+# Addends cancel in pairs across a long chain of ADD gates, and the chain is
+# normalized once rather than at every gate
+def test_normalize_gf2():
+    a, b, c = scdf.vect_input('a', 3)
+    assert scdf.normalize_gf2(a + b + a) is b
+    assert scdf.normalize_gf2((a * b) * a).fingerprint == (a * b).fingerprint
+    n = 3000
+    x = scdf.vect_input('x', n)
+    y = scdf.vect_input('y', n)
+    s = x[0] * y[0]
+    for i in range(1, n):
+        s = s + x[i] * y[i]
+    for i in range(n):
+        s = s + y[i] * x[i] * x[i]
+    assert scdf.normalize_gf2(s + c) is c
+    print 'GF(2) normalization checked on a sum of', 2 * n + 1, 'terms'
+
+# Each x_i*y_i + x_i*z_i is factored to x_i*(y_i + z_i) in a sum too long for
+# recursion over its terms
+def test_simplify_long_sum():
+    n = 3000
+    x = scdf.vect_input('x', n)
+    y = scdf.vect_input('y', n)
+    z = scdf.vect_input('z', n)
+    s = x[0] * y[0] + x[0] * z[0]
+    for i in range(1, n):
+        s = s + (x[i] * y[i] + x[i] * z[i])
+    simplified = scdf.simplify(s)
+    assert scdf.count_gates(simplified, set([scdf.Gate.MUL])) == n
+    assert scdf.compute_depth(simplified) == 1
+
+    rng = random.Random(10)
+    for k in range(5):
+        input_map = dict((node.name, testutils.random_bit(rng))
+                         for v in [x, y, z] for node in v)
+        values = testutils.bit_values(scdf.eval_circuit(
+            [simplified, s], input_map, testutils.map_constant))
+        assert values[0] == values[1]
+    print 'Simplified a sum of', 2 * n, 'products'
+
+# Products also used outside a sum are not factored, since that would add
+# multiplications
+def test_simplify_shared():
+    mul = set([scdf.Gate.MUL])
+    a, b, c = scdf.vect_input('a', 3)
+    ab, ac = a * b, a * c
+    for outputs in [[ab + ac, ab, ac], [a * b + a * c, a * b, a * c],
+                    [(ab + ac) * ab]]:
+        simplified = scdf.simplify(outputs)
+        assert scdf.count_gates(simplified, mul) <= \
+            scdf.count_gates(scdf.deduplicate(outputs), mul)
+    assert scdf.count_gates(scdf.simplify(ab + ac), mul) == 1
+
+    rng = random.Random(17)
+    for N, nbits in [(4, 4), (5, 3)]:
+        case = testutils.direct_sort_case(N, nbits)
+        outputs = scdf.normalize_gf2(case.outputs)
+        simplified = scdf.simplify(outputs)
+        assert scdf.count_gates(simplified, mul) < \
+            scdf.count_gates(outputs, mul)
+        for k in range(5):
+            input_map = case.random_inputs(rng)
+            assert testutils.bit_values(scdf.eval_circuit(
+                simplified, input_map, case.map_constant)) == \
+                case.expected(input_map)
+    print 'Simplified sums of shared products'
+
+def check_fold_gate():
+    a = scdf.Input('a')
+    zero = scdf.Constant(0)
+    one = scdf.Constant(1)
+    assert scdf.fold_gate(scdf.Gate.MUL, a, zero) is zero
+    assert scdf.fold_gate(scdf.Gate.MUL, one, a) is a
+    assert scdf.fold_gate(scdf.Gate.ADD, zero, a) is a
+    assert scdf.fold_gate(scdf.Gate.ADD, one, one, 2) is zero
+    assert scdf.fold_gate(scdf.Gate.ADD, a, one) is None
+    assert scdf.fold_gate(scdf.Gate.SHIFT_LEFT, scdf.Constant((1, 0, 0)), 1,
+                          None, 3) is scdf.Constant((0, 0, 1))
+
+# Folding constants as gates are built gives the circuit that folding them
+# afterwards gives, with the same values
+def test_build_time_folding():
+    rng = random.Random(18)
+    N = 4
+    nbits = 3
+    names = ['X%d%d' % (i, k) for i in range(N) for k in range(nbits)]
+    for build in [lambda X: sort.direct_sort_p(X),
+                  lambda X: sort.sn_sort_p(sort.odd_even_merge_network(N), X),
+                  lambda X: [hamming.hamming_weight(
+                      [scdf.Constant(1)] + X[0] + [scdf.Constant(0)])]]:
+        outputs = [b for y in build(scdf.array_input('X', N, nbits))
+                   for b in y]
+        folded = scdf.fold_constants(outputs, None, 2, N)
+        scdf.set_constant_folding(True, 2, N)
+        try:
+            built = [b for y in build(scdf.array_input('X', N, nbits))
+                     for b in y]
+        finally:
+            scdf.set_constant_folding(False)
+        assert scdf.count_gates(built) == scdf.count_gates(folded) < \
+            scdf.count_gates(outputs)
+        for c1, c2 in zip(built, folded):
+            assert scdf.compare_circuits(c1, c2, True)
+        map_constant = slots.constant_mapper(N)
+        for k in range(5):
+            input_map = random_vectors(names, N, 2, rng)
+            values = [[list(value.slots) for value in
+                       scdf.eval_circuit(circ, input_map, map_constant)]
+                      for circ in [built, folded, outputs]]
+            assert values[0] == values[1] == values[2]
+    print 'Build-time constant folding checked'
+
+def bits_map(name, value, nbits, wrap=lambda bit: bit):
+    bits = utils.to_bin(value, nbits)
+    return dict(('%s%d' % (name, i), wrap(bits[i])) for i in range(nbits))
+
+# Specializing a < b on every value of b leaves a circuit in a alone that
+# agrees with the full circuit on every value of a
+def test_specialize():
+    check_fold_gate()
+    nbits = 4
+    lt = base.lt(scdf.vect_input('a', nbits), scdf.vect_input('b', nbits))
+    for y in range(2**nbits):
+        residual, stats = scdf.specialize(lt, bits_map('b', y, nbits), 2)
+        assert stats['gates_after'] < stats['gates_before']
+        for x in range(2**nbits):
+            input_map = bits_map('a', x, nbits, testutils.Bit)
+            full = dict(input_map)
+            full.update(bits_map('b', y, nbits, testutils.Bit))
+            value = scdf.eval_circuit(residual, input_map,
+                                      testutils.map_constant).val
+            assert value == \
+                scdf.eval_circuit(lt, full, testutils.map_constant).val
+            assert value == int(x < y)
+    print 'Specialized comparisons checked'
+
+def random_vectors(names, nslots, modulus, rng):
+    return dict((name, slots.SlotVector([rng.randrange(modulus)
+                                         for i in range(nslots)], modulus))
+                for name in names)
+
+def check_rotations(outputs, names, nslots, rng):
+    for modulus in [2, 7]:
+        input_map = random_vectors(names, nslots, modulus, rng)
+        map_constant = slots.constant_mapper(nslots, modulus)
+        expected = [list(value.slots) for value in
+                    scdf.eval_circuit(outputs, input_map, map_constant)]
+        before = scdf.rotation_stats(outputs)['rotations']
+        for n in [None, nslots]:
+            merged = scdf.merge_rotations(outputs, n)
+            values = scdf.eval_circuit(merged, input_map, map_constant)
+            assert [list(value.slots) for value in values] == expected
+            stats = scdf.rotation_stats(merged, n)
+            assert stats['rotations'] < before
+            if n is not None:
+                assert all(0 < amount < n for amount in stats['amounts'])
+    return before, scdf.rotation_stats(merged, nslots)['rotations']
+
+# Merging rotations leaves the values of SIMD circuits unchanged and removes
+# rotations, with and without the number of slots
+def test_merge_rotations():
+    rng = random.Random(13)
+    nslots = 8
+    x, y = scdf.Input('x'), scdf.Input('y')
+    outputs = [((x << 3) >> 1) << 6,
+               ((x << 1) + (y << 2)) << 3,
+               (x << 5) + (y << 5),
+               (x >> 2) * ((x << 6) << 0)]
+    assert scdf.rotation_stats(outputs, nslots)['amounts'] == \
+        [0, 1, 2, 3, 5, 6, 7]
+    before, after = check_rotations(outputs, ['x', 'y'], nslots, rng)
+    print 'Rotations merged from', before, 'to', after
+
+    N = 8
+    nbits = 2
+    Y = sort.sn_sort_p(sort.odd_even_merge_network(N),
+                       scdf.array_input('X', N, nbits))
+    names = ['X%d%d' % (i, k) for i in range(N) for k in range(nbits)]
+    before, after = check_rotations([b for y in Y for b in y], names, N, rng)
+    print 'Rotations of the SIMD network sort merged from', before, 'to', after
+
+def check_mod_switches(outputs, names, rng):
+    placed = scdf.place_mod_switches(outputs)
+    assert scdf.count_gates(placed, set([scdf.Gate.MOD_SWITCH])) > 0
+    levels = {}
+    assert scdf.compute_level(placed, levels) == scdf.compute_level(outputs)
+    for node in scdf.postorder(placed):
+        if node.is_terminal or scdf.is_unary(node):
+            continue
+        operand_levels = [levels[node.left], levels[node.right]]
+        assert None in operand_levels or \
+            operand_levels[0] == operand_levels[1]
+    for k in range(10):
+        input_map = dict((name, testutils.random_bit(rng)) for name in names)
+        assert testutils.bit_values(scdf.eval_circuit(
+            placed, input_map, testutils.map_constant)) == \
+            testutils.bit_values(scdf.eval_circuit(
+                outputs, input_map, testutils.map_constant))
+    return scdf.count_gates(placed, set([scdf.Gate.MOD_SWITCH]))
+
+# After placement the operands of every gate are at the same level, without
+# raising the level of the outputs or changing their values
+def test_place_mod_switches():
+    rng = random.Random(14)
+    # Inputs are fresh ciphertexts at level 0, and c is needed at level 1 by
+    # the second product and a at level 2 by the sum, so each is switched
+    # once
+    a, b, c = scdf.vect_input('a', 3)
+    ab = a * b
+    abc = ab * c
+    half = scdf.Constant(3)
+    levels = scdf.assign_levels([abc + a, half * half])
+    assert [levels[node] for node in [a, b, c, ab, abc]] == [0, 0, 0, 1, 2]
+    assert levels[half] is None
+    switches = check_mod_switches([abc + a], ['a0', 'a1', 'a2'], rng)
+    assert switches == 2
+
+    num_bits = 16
+    w = hamming.hamming_weight(scdf.vect_input('v', num_bits))
+    switches = check_mod_switches(w, ['v%d' % i for i in range(num_bits)],
+                                  rng)
+    print 'Placed', switches, 'modulus switches in the hamming weight'
+
+    N = 4
+    nbits = 3
+    Y = sort.sn_sort(sort.odd_even_merge_network(N),
+                     scdf.array_input('X', N, nbits))
+    switches = check_mod_switches(
+        [b for y in Y for b in y],
+        ['X%d%d' % (i, k) for i in range(N) for k in range(nbits)], rng)
+    print 'Placed', switches, 'modulus switches in the network sort'
+
+# Copied and unpickled circuits keep their structure, tags and values
+def test_copy():
+    a, b = scdf.vect_input('a', 2)
+    with scdf.region('sum'):
+        circ = ((a * b + scdf.Constant((1, 0))) << 1) + (a + a).mod_switch(1)
+    copies = [copy.deepcopy(circ)]
+    for protocol in [0, 1, 2]:
+        copies.append(pickle.loads(pickle.dumps(circ, protocol)))
+    rng = random.Random(16)
+    for other in copies:
+        assert scdf.compare_circuits(circ, other, True)
+        assert other.tag == 'sum'
+        assert [node.fingerprint for node in scdf.postorder(other)] == \
+            [node.fingerprint for node in scdf.postorder(circ)]
+        constants = [node for node in scdf.postorder(other)
+                     if node.is_terminal and node.is_constant]
+        assert constants == [scdf.Constant((1, 0))]
+        for k in range(4):
+            input_map = random_vectors(['a0', 'a1'], 2, 2, rng)
+            map_constant = slots.constant_mapper(2)
+            value = scdf.eval_circuit(other, input_map, map_constant)
+            assert list(value.slots) == list(
+                scdf.eval_circuit(circ, input_map, map_constant).slots)
+    print 'Circuits copied and pickled'
+
+# With interning on, equal nodes are built once, which deduplicating a circuit
+# built with interning off also achieves
+def test_interning():
+    plain = testutils.direct_sort_case().outputs
+    scdf.set_interning(True)
+    try:
+        a, b = scdf.Input('a'), scdf.Input('b')
+        assert scdf.Input('x') is scdf.Input('x')
+        assert (a * b) is (b * a)
+        assert (a + b) is (b + a)
+        assert (a << 1) is (a << 1)
+        interned = testutils.direct_sort_case().outputs
+    finally:
+        scdf.set_interning(False)
+        scdf.clear_unique_table()
+    deduplicated = scdf.deduplicate(plain)
+    assert len(list(scdf.postorder(deduplicated))) == \
+        len(list(scdf.postorder(interned))) < len(list(scdf.postorder(plain)))
+    assert scdf.count_gates_by_type(deduplicated) == \
+        scdf.count_gates_by_type(interned)
+    for c1, c2 in zip(deduplicated, interned):
+        assert scdf.compare_circuits(c1, c2, True)
+    print 'Interned build of', len(list(scdf.postorder(interned))), \
+        'nodes matches the deduplicated build'
+
+# Confirmation accepts circuits equal up to commuting operands and rejects
+# circuits whose fingerprints collide, which are forced here
+def test_compare_circuits():
+    a, b, c, d = scdf.vect_input('a', 4)
+    circ1 = ((a * b + c) * d) << 2
+    circ2 = (d * (c + b * a)) << 2
+    assert scdf.compare_circuits(circ1, circ2, True)
+    assert not scdf.compare_circuits(circ1, (d * (c + b * a)) << 1, True)
+    assert not scdf.compare_circuits(circ1, (d * (c + b * b)) << 2, True)
+
+    x, y = scdf.Input('x'), scdf.Input('y')
+    y._fingerprint = x.fingerprint
+    circ1 = a * (x + b)
+    circ2 = (b + y) * a
+    assert scdf.compare_circuits(circ1, circ2)
+    assert not scdf.compare_circuits(circ1, circ2, True)
+
+    product, sum_ = a * b, a + b
+    sum_._fingerprint = product.fingerprint
+    circ1 = (product << 1) * c
+    circ2 = c * (sum_ << 1)
+    assert scdf.compare_circuits(circ1, circ2)
+    assert not scdf.compare_circuits(circ1, circ2, True)
+
+    outputs = [testutils.direct_sort_case().outputs for k in range(2)]
+    for c1, c2 in zip(*outputs):
+        assert c1 is not c2
+        assert scdf.compare_circuits(c1, c2, True)
+    print 'Circuit comparisons confirmed'
+
+# Constants are shared per value and type, and only while they are in use
+def test_constants():
+    one = scdf.Constant(1)
+    assert scdf.Constant(1) is one
+    assert scdf.Constant(True) is not one
+    assert scdf.Constant(1.0) is not one
+    assert scdf.Constant(True).value is True
+    assert scdf.deduplicate([one, scdf.Constant(True)])[1].value is True
+    x = scdf.Input('x')
+    products = [x * scdf.Constant(i + 2) for i in range(1000)]
+    refs = [weakref.ref(scdf.Constant(i + 2)) for i in range(1000)]
+    del products
+    gc.collect()
+    assert all(ref() is None for ref in refs)
+    assert (int, 2) not in scdf._constants
+    print 'Constants shared'
+
+test_shared_cache()
+test_constants()
+test_copy()
+test_interning()
+test_compare_circuits()
+test_normalize_gf2()
+test_simplify_long_sum()
+test_simplify_shared()
+test_specialize()
+test_build_time_folding()
+test_merge_rotations()
+test_place_mod_switches()
@@ -1,24 +1,9 @@
+import math
+import random
 import scdf
 import utils
 import sort
-
-class BinVector:
-    def __init__(self, elems):
-        self.num_slots = len(elems)
-        self.elems = list(elems)
-        
-    def __lshift__(self, num_places):
-        return BinVector(self.elems[num_places:] + self.elems[:num_places])
-
-    def __rshift__(self, num_places):
-        return BinVector(self.elems[-num_places:] + self.elems[:self.num_slots - num_places])
-
-    def __mul__(self, other):
-        return BinVector(map(lambda (x, y): (x * y) % 2, zip(self.elems, other.elems)))
-
-    def __add__(self, other):
-        return BinVector(map(lambda (x, y): (x + y) % 2, zip(self.elems, other.elems)))
-
+import slots
 
 # number of bits in each element
 nbits = 8
@@ -26,18 +11,15 @@ nbits = 8
 # number of elements in the array to sort
 N = 8
 
-# dimension of the bin vectors
+# number of slots in each vector
 nslots = 8
-def map_constant(constant):
-    return BinVector([constant] * nslots)
+map_constant = slots.constant_mapper(nslots)
 
 def add_num_to_map(name, num, input_map):
     bin_rep = utils.to_bin(num, nbits)
 
     for i in range(nbits):
-        vect = [0] * nslots
-        vect[0] = bin_rep[i]
-        input_map['%s%d' % (name, i)] = BinVector(vect)
+        input_map['%s%d' % (name, i)] = slots.unit(bin_rep[i], nslots)
 
 def add_array_to_map(name, array, input_map):
     for i in range(len(array)):
@@ -52,14 +34,26 @@ def unpack_array(elements):
     for element in elements:
         bits = []
         for b in element:
-            bits.append(b.elems[0])
+            bits.append(b.slots[0])
 
         array.append(utils.from_bin(bits))
     return array
 
 
-# A sorting network for 5 elements
-#sorting_network = [(1, 2), (4, 3), (2, 3), (0, 2), (1, 4), (2, 4), (3, 4), (0, 2), (0, 1)]
+# Folds constants, reduces the depth and evaluates the sorted elements Y,
+# returning the sorted array, the maximum depth and the number of gates. The
+# passes run on all output bits at once, so gates shared between bits are
+# built and counted once.
+def evaluate_sort(Y):
+    bits = [b for y in Y for b in y]
+    bits = scdf.fold_constants(bits, None, 2, nslots)
+    bits = scdf.reduce_depth(bits)
+    max_depth = scdf.compute_depth(bits)
+    gate_count = scdf.count_gates(bits, set([scdf.Gate.ADD, scdf.Gate.MUL]))
+    values = scdf.eval_circuit(bits, input_map, map_constant)
+    elements = [values[i:i + nbits] for i in range(0, len(values), nbits)]
+    return unpack_array(elements), max_depth, gate_count
+
 
 X = scdf.array_input('X', N, nbits)
 Y = sort.direct_sort_p(X)
@@ -67,22 +61,55 @@ Y = sort.direct_sort_p(X)
 input_map = {}
 add_array_to_map('X', [5, 3, 2, 4, 1, 7, 8, 6], input_map)
 
+array, max_depth, gate_count = evaluate_sort(Y)
+sn_array, sn_max_depth, sn_gate_count = evaluate_sort(
+    sort.sn_sort_p(sort.odd_even_merge_network(N), X))
 
-elements = []
-max_depth = 0
-gate_count = 0
-for y in Y:
-    element = []
-    for b in y:
-        b = scdf.reduce_depth(b)
-        d = scdf.compute_depth(b)
-        if d > max_depth:
-            max_depth = d
-        gate_count += scdf.count_gates(b, set([scdf.Gate.ADD, scdf.Gate.MUL]))
-        element.append(scdf.eval_circuit(b, input_map, map_constant))
-    elements.append(element)
-
-print 'Sorted Array:', unpack_array(elements)
+bits = [b for y in Y for b in y]
+mul_counts = [scdf.count_gates(circs, set([scdf.Gate.MUL]))
+              for circs in [bits, scdf.normalize_gf2(bits)]]
+
+print 'Sorted Array:', array
 print 'Max Depth:', max_depth
 print 'Gate Count:', gate_count
-
+print 'Sorted Array (odd-even merge network):', sn_array
+print 'Max Depth (odd-even merge network):', sn_max_depth
+print 'Gate Count (odd-even merge network):', sn_gate_count
+print 'MULs removed by GF(2) normalization:', mul_counts[0] - mul_counts[1]
+
+
+# Bit i of the slot-wise hamming weight used by direct_sort_p has depth i, and
+# for 4 and 8 elements it is the circuit of Cetin, Doroz, Sunar and Savas
+def check_weight_depths(n):
+    log_n = int(math.ceil(math.log(n, 2)))
+    v = scdf.vect_input('m', n)
+    weight = sort.hamming_weight(v, log_n)
+    assert [scdf.compute_depth(b) for b in weight] == range(log_n)
+    if n in [4, 8]:
+        cdss = sort.hamming_weight_cdss(v)[:log_n]
+        assert [scdf.compute_depth(b) for b in weight] == \
+            [scdf.compute_depth(b) for b in cdss]
+        for b1, b2 in zip(weight, cdss):
+            assert scdf.compare_circuits(b1, b2, True)
+
+# Sorts random arrays of distinct elements with direct_sort_p on n slots
+def check_direct_sort_p(n, num_bits, rng):
+    check_weight_depths(n)
+    Y = sort.direct_sort_p(scdf.array_input('X', n, num_bits))
+    bits = [b for y in Y for b in y]
+    for k in range(3):
+        array = rng.sample(range(2**num_bits), n)
+        inputs = {}
+        for i in range(n):
+            element = utils.to_bin(array[i], num_bits)
+            for j in range(num_bits):
+                inputs['X%d%d' % (i, j)] = slots.unit(element[j], n)
+        values = scdf.eval_circuit(bits, inputs, slots.constant_mapper(n))
+        assert [utils.from_bin([b.slots[0] for b in
+                                values[i*num_bits:(i + 1)*num_bits]])
+                for i in range(n)] == sorted(array)
+
+rng = random.Random(19)
+for n in [4, 5, 8, 12, 16]:
+    check_direct_sort_p(n, 5, rng)
+print 'SIMD direct sort checked for 4, 5, 8, 12 and 16 elements'
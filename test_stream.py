@@ -0,0 +1,142 @@
+import os
+import random
+import shutil
+import tempfile
+import arith
+import bitslice
+import scdf
+import sort
+import stream
+import tape
+
+# number of assignments evaluated at once
+width = 1024
+
+# Packed assignments, with ADD as XOR and MUL as AND
+class Word(object):
+    __slots__ = ('bits',)
+
+    def __init__(self, bits):
+        self.bits = bits
+
+    def __add__(self, other):
+        return Word(self.bits ^ other.bits)
+
+    def __mul__(self, other):
+        return Word(self.bits & other.bits)
+
+def map_constant(value):
+    return Word((1 << width) - 1 if value % 2 else 0)
+
+def test_direct_sort(directory):
+    N = 4
+    nbits = 3
+    builder = stream.Builder(os.path.join(directory, 'direct_sort'))
+    Y = sort.direct_sort(builder.array_input('X', N, nbits))
+    log = builder.close([b for y in Y for b in y])
+
+    # the log holds the same circuit as an in-memory build
+    outputs = [b for y in sort.direct_sort(scdf.array_input('X', N, nbits))
+               for b in y]
+    assert stream.count_gates_by_type(log) == \
+        scdf.count_gates_by_type(outputs)
+    assert stream.compute_depth(log) == scdf.compute_depth(outputs)
+    assert scdf.count_gates(stream.to_circuits(log)) == \
+        stream.count_gates(log)
+
+    rng = random.Random(4)
+    input_map = bitslice.random_inputs(log.input_names, width, rng)
+    values = stream.evaluate(log, dict((name, Word(word)) for name, word
+                                       in input_map.iteritems()),
+                             map_constant)
+    values = [value.bits for value in values]
+    assert values == bitslice.eval_batch(outputs, input_map, width)
+
+    checked = 0
+    elements = [bitslice.unpack_numbers([input_map['X%d%d' % (i, k)]
+                                         for k in range(nbits)], width)
+                for i in range(N)]
+    results = [bitslice.unpack_numbers(values[i*nbits:(i + 1)*nbits], width)
+               for i in range(N)]
+    for j in range(width):
+        array = [elements[i][j] for i in range(N)]
+        # direct sort requires distinct elements
+        if len(set(array)) != N:
+            continue
+        assert [results[i][j] for i in range(N)] == sorted(array)
+        checked += 1
+    log.close()
+    print 'Streamed direct sort of', len(log), 'records checked on', \
+        checked, 'arrays'
+
+def test_write(directory):
+    a = scdf.vect_input('a', 3)
+    outputs = [(a[0] * a[1] + scdf.Constant((1, 0))) << 1,
+               (a[2] * a[0]).mod_switch(1)]
+    log = stream.write(outputs, os.path.join(directory, 'write'))
+    circuits = stream.to_circuits(log)
+    assert [c.fingerprint for c in circuits] == \
+        [c.fingerprint for c in outputs]
+    assert log.constants == [(1, 0)]
+    log.close()
+    print 'Circuits written to a node log and read back'
+
+# Streams f applied to two nbits-bit operands and checks the log against the
+# circuit built in memory
+def check_streamed(f, nbits, path, rng):
+    builder = stream.Builder(path)
+    log = builder.close(f(builder.vect_input('a', nbits),
+                          builder.vect_input('b', nbits)))
+    outputs = f(scdf.vect_input('a', nbits), scdf.vect_input('b', nbits))
+    assert stream.count_gates_by_type(log) == \
+        scdf.count_gates_by_type(outputs)
+    assert stream.compute_depth(log) == scdf.compute_depth(outputs)
+
+    input_map = bitslice.random_inputs(log.input_names, width, rng)
+    values = stream.evaluate(log, dict((name, Word(word)) for name, word
+                                       in input_map.iteritems()),
+                             map_constant)
+    assert [value.bits for value in values] == \
+        bitslice.eval_batch(outputs, input_map, width)
+    log.close()
+
+# The arith builders order bits by depth and build balanced product trees,
+# which use the depths and fingerprints of the handles
+def test_arith(directory):
+    rng = random.Random(15)
+    nbits = 5
+    path = os.path.join(directory, 'arith')
+    for f in [arith.kogge_stone_add, arith.wallace_mul, arith.dadda_mul,
+              lambda a, b: arith.carry_save_add([a, b, a, b]),
+              lambda a, b: [scdf.Constant(0)] + arith.sub(a, b),
+              lambda a, b: [arith.lt_tree(a, b)],
+              lambda a, b: [arith.eq_tree(a, b)]]:
+        check_streamed(f, nbits, path, rng)
+    print 'Streamed arithmetic primitives checked on', width, 'assignments'
+
+# Handles are not circuits, and the passes of scdf say so
+def test_passes_reject_handles(directory):
+    builder = stream.Builder(os.path.join(directory, 'handles'))
+    a, b = builder.vect_input('a', 2)
+    outputs = [a * b, scdf.Input('c') * scdf.Input('d')]
+    for f in [lambda: scdf.eval_circuit(outputs, {}, map_constant),
+              lambda: scdf.deduplicate(outputs),
+              lambda: scdf.compute_depth(outputs),
+              lambda: tape.compile(outputs)]:
+        try:
+            f()
+        except Exception as e:
+            assert str(e).startswith('Not a circuit node')
+        else:
+            assert False
+    builder.close(outputs).close()
+    print 'Handles rejected by the circuit passes'
+
+directory = tempfile.mkdtemp()
+try:
+    test_direct_sort(directory)
+    test_arith(directory)
+    test_passes_reject_handles(directory)
+    test_write(directory)
+finally:
+    shutil.rmtree(directory)
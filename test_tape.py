@@ -0,0 +1,22 @@
+import random
+import tape
+import testutils
+
+# The tape is compiled once and replayed on several input maps, each of which
+# must give the same outputs as walking the circuit
+def check(case, rng):
+    compiled = tape.compile(case.outputs)
+    for i in range(10):
+        input_map = case.random_inputs(rng)
+        assert case.unpack(compiled.evaluate(input_map, case.map_constant)) == \
+            case.expected(input_map)
+    print case.name, 'tape of', len(compiled), 'instructions checked'
+
+def test_tape():
+    rng = random.Random(5)
+    for case in [testutils.hamming_weight_case(),
+                 testutils.direct_sort_case(),
+                 testutils.direct_sort_p_case()]:
+        check(case, rng)
+
+test_tape()
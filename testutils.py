@@ -0,0 +1,73 @@
+import hamming
+import scdf
+import slots
+import sort
+
+# Plaintext bits, with ADD as XOR and MUL as AND
+class Bit(object):
+    def __init__(self, val):
+        self.val = val % 2
+
+    def __mul__(self, other):
+        return Bit(self.val * other.val)
+
+    def __add__(self, other):
+        return Bit(self.val + other.val)
+
+    def __eq__(self, other):
+        return self.val == other.val
+
+def map_constant(constant):
+    return Bit(constant)
+
+def random_bit(rng):
+    return Bit(rng.getrandbits(1))
+
+def bit_values(values):
+    return [value.val for value in values]
+
+def slot_values(values):
+    return [list(value.slots) for value in values]
+
+def element_names(N, nbits):
+    return ['X%d%d' % (i, k) for i in range(N) for k in range(nbits)]
+
+# A circuit to check an evaluator on, along with how to draw random values for
+# its inputs, how to map its constants and how to compare its output values
+class Case(object):
+    def __init__(self, name, outputs, input_names, random_value, map_constant,
+                 unpack):
+        self.name = name
+        self.outputs = outputs
+        self.input_names = input_names
+        self.random_value = random_value
+        self.map_constant = map_constant
+        self.unpack = unpack
+
+    def random_inputs(self, rng):
+        return dict((name, self.random_value(rng))
+                    for name in self.input_names)
+
+    # The output values from walking the circuit, which evaluators must match
+    def expected(self, input_map):
+        return self.unpack(scdf.eval_circuit(self.outputs, input_map,
+                                             self.map_constant))
+
+def hamming_weight_case(num_bits=24):
+    outputs = hamming.hamming_weight(scdf.vect_input('v', num_bits))
+    return Case('Hamming weight', outputs,
+                ['v%d' % i for i in range(num_bits)], random_bit,
+                map_constant, bit_values)
+
+def direct_sort_case(N=4, nbits=3):
+    Y = sort.direct_sort(scdf.array_input('X', N, nbits))
+    return Case('Direct sort', [b for y in Y for b in y],
+                element_names(N, nbits), random_bit, map_constant, bit_values)
+
+# The SIMD version has rotations and tuple constants
+def direct_sort_p_case(N=4, nbits=3):
+    Y = sort.direct_sort_p(scdf.array_input('X', N, nbits))
+    return Case('SIMD direct sort', [b for y in Y for b in y],
+                element_names(N, nbits),
+                lambda rng: slots.unit(rng.getrandbits(1), N),
+                slots.constant_mapper(N), slot_values)